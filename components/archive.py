@@ -0,0 +1,328 @@
+#!/usr/bin/python3
+import json
+import os
+import struct
+import sys
+import time
+import zipfile
+import zlib
+from functools import partial
+from typing import BinaryIO, Callable, Optional, Tuple
+
+
+# The end of central directory record, the archive comment follows it
+EOCD = struct.Struct('<4s4H2LH')
+EOCD_SIGNATURE = b'PK\x05\x06'
+
+# A member's local file header, the name and extra field follow it
+FILE_HEADER = struct.Struct('<4s2B4HL2L2H')
+FILE_HEADER_SIGNATURE = b'PK\x03\x04'
+_FH_SIGNATURE = 0
+_FH_FLAGS = 3
+_FH_COMPRESSION_METHOD = 4
+_FH_LAST_MOD_TIME = 5
+_FH_LAST_MOD_DATE = 6
+_FH_CRC = 7
+_FH_COMPRESSED_SIZE = 8
+_FH_UNCOMPRESSED_SIZE = 9
+_FH_FILENAME_LENGTH = 10
+_FH_EXTRA_FIELD_LENGTH = 11
+ZIP64_LIMIT = (1 << 31) - 1
+
+# The zipfile internals raw members are written with, members are compressed again by writestr if any are missing
+RAW_ARCHIVE_ATTRIBUTES = ('_lock', '_writing', '_writecheck', '_didModify', '_seekable', 'start_dir', 'fp', 'filelist', 'NameToInfo')
+
+
+def read_comment(path: str) -> Optional[str]:
+    """Read the archive comment from the end of the file without loading the central directory.
+
+    Args:
+        path (str): The archive.
+
+    Raises:
+        zipfile.BadZipFile: The file has no end of central directory record, like an archive that was never closed.
+
+    Returns:
+        Optional[str]: The comment, None if the file doesn't exist.
+    """
+    try:
+        with open(path, 'rb') as archive_file:
+            archive_file.seek(0, os.SEEK_END)
+            file_size = archive_file.tell()
+            # The comment is at most 65535 bytes long
+            read_size = min(file_size, EOCD.size + 0xFFFF)
+            archive_file.seek(file_size - read_size)
+            tail = archive_file.read()
+    except FileNotFoundError:
+        return None
+
+    start = tail.rfind(EOCD_SIGNATURE)
+    while start != -1:
+        if start + EOCD.size <= len(tail):
+            comment_length = EOCD.unpack_from(tail, start)[-1]
+            if start + EOCD.size + comment_length == len(tail):
+                return tail[start + EOCD.size:].decode('utf-8', 'replace')
+        start = tail.rfind(EOCD_SIGNATURE, 0, start)
+    raise zipfile.BadZipFile(f'{path} has no end of central directory record')
+
+
+def deflate(data: bytes, level: int=6) -> Tuple[bytes, int, int]:
+    """Compress the data the way zipfile stores deflated members.
+
+    Args:
+        data (bytes): The data to compress.
+        level (int, optional): The deflate level. Defaults to 6.
+
+    Returns:
+        Tuple[bytes, int, int]: The raw deflate stream, the crc of the data and its size.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    return compressed, zlib.crc32(data), len(data)
+
+
+def _supports_raw(archive: zipfile.ZipFile) -> bool:
+    """If this version of zipfile has the internals used to read and write compressed members as they are."""
+    return all(hasattr(archive, a) for a in RAW_ARCHIVE_ATTRIBUTES) and hasattr(zipfile.ZipInfo, 'FileHeader')
+
+
+def _decompress(compressed: bytes, compress_type: int) -> bytes:
+    return compressed if compress_type == zipfile.ZIP_STORED else zlib.decompress(compressed, -15)
+
+
+def _write_raw(archive: zipfile.ZipFile, zinfo: zipfile.ZipInfo, compressed: bytes, data: Callable[[], bytes]) -> zipfile.ZipInfo:
+    """Write the member's header and its already compressed data, zipfile has no public way to do this.
+
+    Falls back to writestr with the uncompressed data if zipfile's internals have changed.
+    """
+    if not _supports_raw(archive):
+        archive.writestr(zinfo, data())
+        return zinfo
+
+    zip64 = max(zinfo.file_size, zinfo.compress_size) > ZIP64_LIMIT
+
+    with archive._lock:
+        if not archive.fp:
+            raise ValueError("Attempt to write to ZIP archive that was already closed")
+        if archive._writing:
+            raise ValueError("Can't write to ZIP archive while an open writing handle exists.")
+
+        archive._writecheck(zinfo)
+        archive._didModify = True
+        if archive._seekable:
+            archive.fp.seek(archive.start_dir)
+
+        zinfo.header_offset = archive.fp.tell()
+        archive.fp.write(zinfo.FileHeader(zip64))
+        archive.fp.write(compressed)
+        archive.filelist.append(zinfo)
+        archive.NameToInfo[zinfo.filename] = zinfo
+        archive.start_dir = archive.fp.tell()
+    return zinfo
+
+
+def write_compressed(archive: zipfile.ZipFile, name: str, compressed: bytes, crc: int, file_size: int, date_time: Optional[tuple]=None) -> zipfile.ZipInfo:
+    """Add an already deflated member to the archive without compressing it again.
+
+    Does what ZipFile.writestr does after the data is compressed.
+
+    Args:
+        archive (zipfile.ZipFile): The archive open for writing.
+        name (str): The member's name.
+        compressed (bytes): The raw deflate stream.
+        crc (int): The crc of the uncompressed data.
+        file_size (int): The size of the uncompressed data.
+        date_time (Optional[tuple], optional): The member's modified time. Defaults to now.
+
+    Raises:
+        ValueError: The archive is closed or being written to.
+
+    Returns:
+        zipfile.ZipInfo: The added member.
+    """
+    zinfo = zipfile.ZipInfo(name, date_time=date_time or time.localtime(time.time())[:6])
+    zinfo.compress_type = zipfile.ZIP_DEFLATED
+    zinfo.external_attr = 0o600 << 16
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(compressed)
+    zinfo.CRC = crc
+    return _write_raw(archive, zinfo, compressed, lambda: _decompress(compressed, zipfile.ZIP_DEFLATED))
+
+
+def read_raw(archive: zipfile.ZipFile, zinfo: zipfile.ZipInfo) -> bytes:
+    """Read the member's data as it's stored in the archive, without decompressing it.
+
+    Args:
+        archive (zipfile.ZipFile): The archive open for reading.
+        zinfo (zipfile.ZipInfo): The member to read.
+
+    Raises:
+        zipfile.BadZipFile: The member's header is missing.
+
+    Returns:
+        bytes: The compressed data.
+    """
+    with archive._lock:
+        archive.fp.seek(zinfo.header_offset)
+        header = FILE_HEADER.unpack(archive.fp.read(FILE_HEADER.size))
+        if header[_FH_SIGNATURE] != FILE_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile(f'Bad magic number for {zinfo.filename}')
+
+        archive.fp.seek(header[_FH_FILENAME_LENGTH] + header[_FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+        return archive.fp.read(zinfo.compress_size)
+
+
+def recover_archive(path: str) -> int:
+    """Rebuild an archive that was never closed from its members' local headers.
+
+    Members are kept up to the first one that was cut off or doesn't match its crc,
+    everything written after it is dropped.
+
+    Args:
+        path (str): The archive.
+
+    Returns:
+        int: The number of members recovered.
+    """
+    members = []
+    with open(path, 'rb') as archive_file:
+        while True:
+            header_data = archive_file.read(FILE_HEADER.size)
+            if len(header_data) < FILE_HEADER.size:
+                break
+
+            header = FILE_HEADER.unpack(header_data)
+            compress_type = header[_FH_COMPRESSION_METHOD]
+            compress_size = header[_FH_COMPRESSED_SIZE]
+            file_size = header[_FH_UNCOMPRESSED_SIZE]
+            flags = header[_FH_FLAGS]
+            # A member still being written has no sizes in its header yet
+            if (header[_FH_SIGNATURE] != FILE_HEADER_SIGNATURE or flags & 0x08 or not file_size
+                    or ZIP64_LIMIT <= max(compress_size, file_size) or compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)):
+                break
+
+            name = archive_file.read(header[_FH_FILENAME_LENGTH])
+            archive_file.read(header[_FH_EXTRA_FIELD_LENGTH])
+            compressed = archive_file.read(compress_size)
+            if len(compressed) < compress_size:
+                break
+
+            try:
+                data = _decompress(compressed, compress_type)
+            except zlib.error:
+                break
+            if len(data) != file_size or zlib.crc32(data) != header[_FH_CRC]:
+                break
+
+            mod_date = header[_FH_LAST_MOD_DATE]
+            mod_time = header[_FH_LAST_MOD_TIME]
+            zinfo = zipfile.ZipInfo(
+                name.decode('utf-8' if flags & 0x800 else 'cp437'),
+                date_time=((mod_date >> 9) + 1980, (mod_date >> 5) & 0xF, mod_date & 0x1F, mod_time >> 11, (mod_time >> 5) & 0x3F, (mod_time & 0x1F) * 2))
+            zinfo.compress_type = compress_type
+            zinfo.external_attr = 0o600 << 16
+            zinfo.file_size = file_size
+            zinfo.compress_size = compress_size
+            zinfo.CRC = header[_FH_CRC]
+            members.append((zinfo, compressed))
+
+    rebuilt_path = f'{path}.rebuild'
+    with zipfile.ZipFile(rebuilt_path, mode='w') as archive:
+        for zinfo, compressed in members:
+            _write_raw(archive, zinfo, compressed, partial(_decompress, compressed, zinfo.compress_type))
+    os.replace(rebuilt_path, path)
+    return len(members)
+
+
+def copy_member(source: zipfile.ZipFile, target: zipfile.ZipFile, zinfo: zipfile.ZipInfo, name: Optional[str]=None) -> zipfile.ZipInfo:
+    """Copy a member to another archive, keeping its compressed data and crc as they are.
+
+    Args:
+        source (zipfile.ZipFile): The archive to copy from.
+        target (zipfile.ZipFile): The archive open for writing.
+        zinfo (zipfile.ZipInfo): The member to copy.
+        name (Optional[str], optional): The member's new name. Defaults to its current name.
+
+    Returns:
+        zipfile.ZipInfo: The added member.
+    """
+    new_zinfo = zipfile.ZipInfo(name or zinfo.filename, date_time=zinfo.date_time)
+    new_zinfo.compress_type = zinfo.compress_type
+    new_zinfo.external_attr = zinfo.external_attr
+    new_zinfo.file_size = zinfo.file_size
+    new_zinfo.compress_size = zinfo.compress_size
+    new_zinfo.CRC = zinfo.CRC
+
+    if not _supports_raw(source):
+        target.writestr(new_zinfo, source.read(zinfo))
+        return new_zinfo
+    return _write_raw(target, new_zinfo, read_raw(source, zinfo), lambda: source.read(zinfo))
+
+
+
+class _ChapterStream:
+    """Counts the bytes written so zipfile can work out the member offsets without seeking."""
+
+    def __init__(self, fp: BinaryIO) -> None:
+        self.fp = fp
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.fp.write(data)
+        self.size += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.size
+
+    def flush(self) -> None:
+        self.fp.flush()
+
+
+
+class ArchiveStream:
+    """Streams each chapter's archive to stdout or a named pipe instead of a file.
+
+    zipfile can't seek the stream, so the members are written with data descriptors.
+    Stdout gets every chapter one after the other, a path is opened again for each chapter.
+
+    Args:
+        target (str): '-' for stdout, otherwise the path to write to.
+        meta_path (Optional[str], optional): Where to write a json line about each chapter streamed. Defaults to None.
+    """
+
+    def __init__(self, target: str, meta_path: Optional[str]=None) -> None:
+        self.target = target
+        self.offset = 0
+        self.meta_file = open(meta_path, 'w', encoding='utf-8', buffering=1) if meta_path else None
+        self._fp = None
+        self._chapter = None
+
+    def open(self) -> _ChapterStream:
+        """Start streaming a chapter."""
+        if self.target == '-':
+            # Printing is moved to stderr when streaming to stdout, write to the real stdout
+            self._fp = sys.__stdout__.buffer
+        else:
+            self._fp = open(self.target, 'wb')
+        self._chapter = _ChapterStream(self._fp)
+        return self._chapter
+
+    def close(self, metadata: dict) -> None:
+        """Finish streaming the chapter and write its metadata line.
+
+        Args:
+            metadata (dict): The chapter's details, its offset in the stream and size are added to it.
+        """
+        self._chapter.flush()
+        size = self._chapter.size
+
+        if self.target == '-':
+            offset = self.offset
+            self.offset += size
+        else:
+            offset = 0
+            self._fp.close()
+
+        if self.meta_file is not None:
+            self.meta_file.write(json.dumps({**metadata, "offset": offset, "size": size}, ensure_ascii=False) + '\n')
@@ -0,0 +1,347 @@
+#!/usr/bin/python3
+import gzip
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, NamedTuple, Optional
+
+
+
+class CacheEntry(NamedTuple):
+    """The details of a stored cache entry used to decide what to evict."""
+    download_id: str
+    size: int
+    last_access: float
+    cached_at: float
+
+
+def normalise_entry(cache_json: dict) -> dict:
+    """Move the chapters' expanded relationships into a shared entities map.
+
+    Feeds fetched with includes repeat the same manga, group and user objects on every
+    chapter, each chapter only keeps the relationship's id and type after this.
+
+    Args:
+        cache_json (dict): The cache entry to store.
+
+    Returns:
+        dict: A copy of the entry with the relationships referenced by id.
+    """
+    chapters = cache_json.get('chapters', [])
+    if not chapters:
+        return cache_json
+
+    entities = {}
+    normalised_chapters = []
+    for chapter in chapters:
+        relationships = []
+        for relationship in chapter.get('relationships', []):
+            if len(relationship) > 2 and 'id' in relationship:
+                entities.setdefault(relationship["id"], relationship)
+                relationship = {"id": relationship["id"], "type": relationship["type"]}
+            relationships.append(relationship)
+        normalised_chapters.append({**chapter, "relationships": relationships})
+
+    return {**cache_json, "chapters": normalised_chapters, "entities": entities}
+
+
+def hydrate_entry(cache_json: dict) -> dict:
+    """Put the shared entities back into the chapters' relationships.
+
+    Args:
+        cache_json (dict): The stored cache entry.
+
+    Returns:
+        dict: The entry as it was before being normalised.
+    """
+    entities = cache_json.pop('entities', None)
+    if not entities:
+        return cache_json
+
+    for chapter in cache_json.get('chapters', []):
+        chapter["relationships"] = [entities.get(r["id"], r) for r in chapter.get('relationships', [])]
+    return cache_json
+
+
+
+class SqliteConnection:
+    """A WAL-mode SQLite connection opened on first use.
+
+    Connections can't be shared with other processes, each process that gets a copy of
+    this, pickled or forked, opens its own.
+
+    Args:
+        db_path (Path): The database file.
+        setup (Callable[[sqlite3.Connection], None]): Creates the tables, called each time the database is opened.
+    """
+
+    def __init__(self, db_path: Path, setup: Callable[[sqlite3.Connection], None]) -> None:
+        self.db_path = db_path
+        self.setup = setup
+        self._db = None
+        self._pid = None
+
+    def __getstate__(self) -> dict:
+        return {**self.__dict__, "_db": None, "_pid": None}
+
+    def connection(self) -> sqlite3.Connection:
+        """The process's connection, opening the database if this process hasn't yet."""
+        if self._db is None or self._pid != os.getpid():
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._pid = os.getpid()
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self.setup(self._db)
+        return self._db
+
+    def close(self) -> None:
+        if self._db is not None and self._pid == os.getpid():
+            self._db.close()
+        self._db = None
+
+
+
+class GzipCache:
+    """Stores each cache entry as its own gzipped json file.
+
+    Args:
+        root (Path): The cache folder.
+        indent (Optional[int], optional): The json indentation, None saves it compact. Defaults to 4.
+        compress_level (int, optional): The gzip compression level. Defaults to 9.
+    """
+
+    def __init__(self, root: Path, indent: Optional[int]=4, compress_level: int=9) -> None:
+        self.root = root
+        self.indent = indent
+        self.compress_level = compress_level
+
+    def _path(self, download_id: str) -> Path:
+        return self.root.joinpath(f'{download_id}').with_suffix('.json.gz')
+
+    def read(self, download_id: str) -> dict:
+        """Load the entry, an empty dict is returned if it doesn't exist or is corrupted."""
+        cache_file_path = self._path(download_id)
+        try:
+            with gzip.open(cache_file_path, 'r') as cache_json_fp:
+                cache_json = json.loads(cache_json_fp.read().decode('utf-8'))
+        except (FileNotFoundError, json.JSONDecodeError, gzip.BadGzipFile, EOFError):
+            return {}
+
+        # The access time orders the entries for eviction, don't rely on the filesystem updating it
+        try:
+            os.utime(cache_file_path, (time.time(), cache_file_path.stat().st_mtime))
+        except OSError:
+            pass
+        return cache_json
+
+    def write(self, download_id: str, cache_json: dict) -> None:
+        """Save the entry, overwriting the whole file."""
+        with gzip.open(self._path(download_id), 'w', compresslevel=self.compress_level) as cache_json_fp:
+            cache_json_fp.write(json.dumps(cache_json, indent=self.indent, ensure_ascii=False).encode('utf-8'))
+
+    def touch(self, download_id: str, cache_json: dict) -> None:
+        """Move the stored entry's cache date to the entry's, the content is left as it is."""
+        stored_json = self.read(download_id)
+        if stored_json:
+            self.write(download_id, {**stored_json, "cache_date": cache_json.get('cache_date', '')})
+
+    def write_many(self, entries: dict) -> None:
+        """Save several entries at once."""
+        for download_id, cache_json in entries.items():
+            self.write(download_id, cache_json)
+
+    def delete(self, download_id: str) -> None:
+        self._path(download_id).unlink(missing_ok=True)
+
+    def delete_many(self, download_ids: list) -> None:
+        for download_id in download_ids:
+            self.delete(download_id)
+
+    def entries(self) -> list:
+        """List the stored entries, the file's modified time is when it was cached."""
+        entries = []
+        with os.scandir(self.root) as cache_files:
+            for cache_file in cache_files:
+                if not cache_file.name.endswith('.json.gz') or not cache_file.is_file():
+                    continue
+                stat = cache_file.stat()
+                entries.append(CacheEntry(cache_file.name[:-len('.json.gz')], stat.st_size, stat.st_atime, stat.st_mtime))
+        return entries
+
+    def disk_size(self) -> int:
+        return sum(e.size for e in self.entries())
+
+    def compact(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+
+class SqliteCache:
+    """Stores the cache entries as rows in a single WAL-mode SQLite database.
+
+    Each entity gets its own row, so saving an entry only touches that row and two
+    processes writing the same id can't leave a half-written entry behind.
+
+    Args:
+        root (Path): The cache folder.
+        expiry (Callable[[dict], datetime]): Works out when an entry goes stale, stored in the indexed expires column.
+        indent (Optional[int], optional): The json indentation, None saves it compact. Defaults to None.
+    """
+
+    def __init__(self, root: Path, expiry: Callable[[dict], datetime], indent: Optional[int]=None) -> None:
+        self.root = root
+        self.expiry = expiry
+        self.indent = indent
+        self.db_path = root.joinpath('cache.db')
+        self.insert_query = 'INSERT OR REPLACE INTO cache (id, cache_date, expires, last_access, data, covers, chapters, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'
+        # The connection is shared with the background refresh thread, CacheRead serialises access to it
+        self._db = SqliteConnection(self.db_path, self._create_table)
+        self._db.connection()
+        self._migrate_gzip_files()
+
+    @staticmethod
+    def _create_table(db: sqlite3.Connection) -> None:
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'id TEXT PRIMARY KEY, '
+            'cache_date TEXT NOT NULL, '
+            'expires REAL NOT NULL, '
+            'last_access REAL NOT NULL DEFAULT 0, '
+            'data TEXT NOT NULL, '
+            'covers TEXT NOT NULL, '
+            'chapters TEXT NOT NULL, '
+            'extra TEXT NOT NULL)')
+
+        columns = [c[1] for c in db.execute('PRAGMA table_info(cache)')]
+        if 'last_access' not in columns:
+            db.execute('ALTER TABLE cache ADD COLUMN last_access REAL NOT NULL DEFAULT 0')
+
+        db.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+        db.execute('CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)')
+
+    def _row(self, download_id: str, cache_json: dict) -> tuple:
+        extra = {k: v for k, v in cache_json.items() if k not in ('cache_date', 'data', 'covers', 'chapters')}
+        return (
+            download_id,
+            cache_json.get('cache_date', ''),
+            self.expiry(cache_json).timestamp(),
+            time.time(),
+            json.dumps(cache_json.get('data', {}), indent=self.indent, ensure_ascii=False),
+            json.dumps(cache_json.get('covers', []), indent=self.indent, ensure_ascii=False),
+            json.dumps(cache_json.get('chapters', []), indent=self.indent, ensure_ascii=False),
+            json.dumps(extra, ensure_ascii=False))
+
+    def read(self, download_id: str) -> dict:
+        """Load the entry, an empty dict is returned if it doesn't exist or is corrupted."""
+        row = self._db.connection().execute(
+            'SELECT cache_date, data, covers, chapters, extra FROM cache WHERE id = ?', (download_id,)).fetchone()
+        if row is None:
+            return {}
+
+        try:
+            cache_json = json.loads(row[4])
+            cache_json.update({"cache_date": row[0], "data": json.loads(row[1]), "covers": json.loads(row[2]), "chapters": json.loads(row[3])})
+        except json.JSONDecodeError:
+            return {}
+
+        self._db.connection().execute('UPDATE cache SET last_access = ? WHERE id = ?', (time.time(), download_id))
+        return cache_json
+
+    def write(self, download_id: str, cache_json: dict) -> None:
+        """Save the entry, replacing the old row in a single transaction."""
+        self._db.connection().execute(
+            self.insert_query,
+            self._row(download_id, cache_json))
+
+    def touch(self, download_id: str, cache_json: dict) -> None:
+        """Move the row's cache date and expiry to the entry's, the content columns are left as they are."""
+        self._db.connection().execute(
+            'UPDATE cache SET cache_date = ?, expires = ?, last_access = ? WHERE id = ?',
+            (cache_json.get('cache_date', ''), self.expiry(cache_json).timestamp(), time.time(), download_id))
+
+    def write_many(self, entries: dict) -> None:
+        """Save several entries in one transaction."""
+        db = self._db.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany(
+                self.insert_query,
+                [self._row(download_id, cache_json) for download_id, cache_json in entries.items()])
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def delete(self, download_id: str) -> None:
+        self._db.connection().execute('DELETE FROM cache WHERE id = ?', (download_id,))
+
+    def delete_many(self, download_ids: list) -> None:
+        db = self._db.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany('DELETE FROM cache WHERE id = ?', [(download_id,) for download_id in download_ids])
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+    def entries(self) -> list:
+        """List the stored entries, the row's size is the length of its json columns."""
+        entries = []
+        rows = self._db.connection().execute(
+            'SELECT id, length(data) + length(covers) + length(chapters) + length(extra), last_access, cache_date FROM cache')
+
+        for download_id, size, last_access, cache_date in rows:
+            try:
+                cached_at = datetime.strptime(cache_date, "%Y-%m-%d %H:%M:%S.%f").timestamp()
+            except ValueError:
+                cached_at = 0
+            entries.append(CacheEntry(download_id, size, last_access, cached_at))
+        return entries
+
+    def disk_size(self) -> int:
+        return sum(p.stat().st_size for p in self.root.glob(f'{self.db_path.name}*'))
+
+    def compact(self) -> None:
+        """Give the space freed by deleted rows back to the filesystem."""
+        db = self._db.connection()
+        db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        db.execute('VACUUM')
+
+    def close(self) -> None:
+        self._db.close()
+
+    def _migrate_gzip_files(self) -> None:
+        """Move the entries from the old gzip cache files into the database."""
+        gzip_cache = GzipCache(self.root)
+        cache_files = list(self.root.glob('*.json.gz'))
+        if not cache_files:
+            return
+
+        print(f'Migrating {len(cache_files)} cache file(s) into {self.db_path}.')
+        db = self._db.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for cache_file in cache_files:
+                download_id = cache_file.name[:-len('.json.gz')]
+                cache_json = gzip_cache.read(download_id)
+                if not cache_json:
+                    continue
+
+                db.execute(
+                    self.insert_query.replace('OR REPLACE', 'OR IGNORE'),
+                    self._row(download_id, cache_json))
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+
+        for cache_file in cache_files:
+            cache_file.unlink(missing_ok=True)
@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+import json
+import mmap
+import os
+import struct
+import uuid
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+
+MAGIC = b'MDCI'
+VERSION = 2
+
+# magic, version, row count, heap start, entities offset, entities length
+HEADER = struct.Struct('<4sHIQQI')
+
+# manga id, volume (offset, length), chapter (offset, length), groups (offset, count),
+# users (offset, count), chapter json (offset, length)
+ROW = struct.Struct('<16sIHIHIHIHQI')
+
+NONE_LENGTH = 0xFFFF
+
+
+
+def _uuid_bytes(value: Optional[str]) -> bytes:
+    try:
+        return uuid.UUID(value).bytes
+    except (TypeError, ValueError, AttributeError):
+        return bytes(16)
+
+
+def uuid_set(ids: Iterable[str]) -> set:
+    """Convert a list of ids into the raw bytes stored in the index."""
+    return {_uuid_bytes(i) for i in ids if i}
+
+
+def write_chapter_index(path: Path, chapters: list) -> None:
+    """Save the chapters as a compact index.
+
+    Each chapter gets a fixed-width row with the fields used for filtering and picking the
+    chapter range, the strings, id lists and the chapter json itself are kept in a heap
+    after the rows. Expanded relationships are stored once in a shared entities map.
+
+    Args:
+        path (Path): Where to save the index.
+        chapters (list): The chapters to save.
+    """
+    heap = bytearray()
+    rows = bytearray()
+    entities = {}
+
+    def add_bytes(data: bytes) -> int:
+        offset = len(heap)
+        heap.extend(data)
+        return offset
+
+    def add_string(value: Optional[str]) -> tuple:
+        if value is None:
+            return 0, NONE_LENGTH
+        encoded = str(value).encode('utf-8')[:NONE_LENGTH - 1]
+        return add_bytes(encoded), len(encoded)
+
+    for chapter in chapters:
+        attributes = chapter.get('attributes', {})
+        relationships = []
+        manga_id = groups = users = None
+        group_ids = []
+        user_ids = []
+
+        for relationship in chapter.get('relationships', []):
+            if relationship["type"] == 'manga' and manga_id is None:
+                manga_id = relationship["id"]
+            elif relationship["type"] == 'scanlation_group':
+                group_ids.append(_uuid_bytes(relationship["id"]))
+            elif relationship["type"] == 'user':
+                user_ids.append(_uuid_bytes(relationship["id"]))
+
+            if len(relationship) > 2:
+                entities.setdefault(relationship["id"], relationship)
+                relationship = {"id": relationship["id"], "type": relationship["type"]}
+            relationships.append(relationship)
+
+        groups = (add_bytes(b''.join(group_ids)), len(group_ids))
+        users = (add_bytes(b''.join(user_ids)), len(user_ids))
+        volume = add_string(attributes.get('volume'))
+        chapter_number = add_string(attributes.get('chapter'))
+        record = json.dumps({**chapter, "relationships": relationships}, ensure_ascii=False).encode('utf-8')
+        record_offset = add_bytes(record)
+
+        rows.extend(ROW.pack(
+            _uuid_bytes(manga_id),
+            *volume,
+            *chapter_number,
+            *groups,
+            *users,
+            record_offset,
+            len(record)))
+
+    entities_offset = add_bytes(json.dumps(entities, ensure_ascii=False).encode('utf-8'))
+    header = HEADER.pack(MAGIC, VERSION, len(chapters), HEADER.size + len(rows), entities_offset, len(heap) - entities_offset)
+
+    # Write next to the old index and swap, so open readers never see a partial file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    part_path = path.with_name(f'{path.name}.{os.getpid()}.part')
+    with open(part_path, 'wb') as index_file:
+        index_file.write(header)
+        index_file.write(rows)
+        index_file.write(heap)
+    os.replace(part_path, path)
+
+
+
+class ChapterIndex:
+    """A memory-mapped chapter index saved by write_chapter_index.
+
+    Rows are read straight from the mapped file, chapter dicts are only built for the rows asked for.
+
+    Args:
+        path (Path): The index to open.
+
+    Raises:
+        ValueError: The file isn't a chapter index this version can read.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise
+
+        magic, version, self.count, self.heap_start, entities_offset, entities_length = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f'{path} is not a chapter index.')
+
+        self._entities_span = (entities_offset, entities_length)
+        self._entities = None
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _row(self, row: int) -> tuple:
+        return ROW.unpack_from(self._map, HEADER.size + row * ROW.size)
+
+    def _heap(self, offset: int, length: int) -> bytes:
+        start = self.heap_start + offset
+        return self._map[start:start + length]
+
+    def _string(self, offset: int, length: int) -> Optional[str]:
+        if length == NONE_LENGTH:
+            return None
+        return self._heap(offset, length).decode('utf-8')
+
+    def _ids(self, offset: int, count: int) -> List[bytes]:
+        data = self._heap(offset, count * 16)
+        return [data[i:i + 16] for i in range(0, len(data), 16)]
+
+    def manga_id(self, row: int) -> str:
+        return str(uuid.UUID(bytes=self._row(row)[0]))
+
+    def volume(self, row: int) -> Optional[str]:
+        values = self._row(row)
+        return self._string(values[1], values[2])
+
+    def chapter_number(self, row: int) -> Optional[str]:
+        values = self._row(row)
+        return self._string(values[3], values[4])
+
+    def group_ids(self, row: int) -> List[bytes]:
+        """The raw 16 byte ids of the chapter's groups, compare them with uuid_set."""
+        values = self._row(row)
+        return self._ids(values[5], values[6])
+
+    def user_ids(self, row: int) -> List[bytes]:
+        """The raw 16 byte ids of the chapter's uploaders, compare them with uuid_set."""
+        values = self._row(row)
+        return self._ids(values[7], values[8])
+
+    def rows_by_manga(self, rows: Iterable[int]) -> dict:
+        """Group the rows by manga id, keeping the first-seen order of the manga."""
+        titles = {}
+        for row in rows:
+            titles.setdefault(self.manga_id(row), []).append(row)
+        return titles
+
+    def _load_entities(self) -> dict:
+        if self._entities is None:
+            self._entities = json.loads(self._heap(*self._entities_span).decode('utf-8'))
+        return self._entities
+
+    def chapter(self, row: int) -> dict:
+        """Build the full chapter dict of the row."""
+        values = self._row(row)
+        chapter = json.loads(self._heap(values[9], values[10]).decode('utf-8'))
+        entities = self._load_entities()
+        chapter["relationships"] = [entities.get(r["id"], r) for r in chapter.get('relationships', [])]
+        return chapter
+
+    def chapters(self, rows: Optional[Iterable[int]]=None) -> list:
+        """Build the chapter dicts of the rows, all of them if none are given."""
+        if rows is None:
+            rows = range(self.count)
+        return [self.chapter(row) for row in rows]
+
+    def close(self) -> None:
+        try:
+            self._map.close()
+        except (AttributeError, BufferError):
+            pass
+        self._file.close()
@@ -19,6 +19,28 @@ class ImpVar:
     RETRY_MAX_TIMES = int(os.getenv("IMAGE_RETRY_MAX_TIMES", 3))
     TIME_TO_SLEEP = int(os.getenv("IMAGE_RETRY_SLEEP", 3))
     CACHE_REFRESH_TIME = int(os.getenv("CACHE_REFRESH_TIME", 24))
+    CACHE_REFRESH_TIME_MANGA = float(os.getenv("CACHE_REFRESH_TIME_MANGA", 168))
+    CACHE_REFRESH_TIME_CHAPTER = float(os.getenv("CACHE_REFRESH_TIME_CHAPTER", 24))
+    CACHE_REFRESH_TIME_GROUP = float(os.getenv("CACHE_REFRESH_TIME_GROUP", 720))
+    CACHE_REFRESH_TIME_USER = float(os.getenv("CACHE_REFRESH_TIME_USER", 720))
+    CACHE_REFRESH_TIME_LIST = float(os.getenv("CACHE_REFRESH_TIME_LIST", 24))
+    CACHE_REFRESH_TIME_FEED = float(os.getenv("CACHE_REFRESH_TIME_FEED", 1))
+    CACHE_REFRESH_TIME_COVERS = float(os.getenv("CACHE_REFRESH_TIME_COVERS", 168))
+    CACHE_REFRESH_TIME_AT_HOME = float(os.getenv("CACHE_REFRESH_TIME_AT_HOME", 0.25))
+    CACHE_REFRESH_TIME_MISSING = float(os.getenv("CACHE_REFRESH_TIME_MISSING", 6))
+    PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", 4))
+    PREFETCH_RATE_LIMIT = float(os.getenv("PREFETCH_RATE_LIMIT", 4))
+    COVER_WORKERS = int(os.getenv("COVER_WORKERS", 8))
+    CACHE_BACKEND = os.getenv("CACHE_BACKEND", 'gzip')
+    CACHE_MEMORY_SIZE = int(os.getenv("CACHE_MEMORY_SIZE", 256))
+    CACHE_WRITE_BEHIND = os.getenv("CACHE_WRITE_BEHIND", 'true').lower() in ('true', '1', 'yes')
+    CACHE_COMPRESSION_LEVEL = int(os.getenv("CACHE_COMPRESSION_LEVEL", 9))
+    CACHE_JSON_INDENT = int(os.getenv("CACHE_JSON_INDENT", 4))
+    CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", 0))
+    CACHE_MAX_AGE = int(os.getenv("CACHE_MAX_AGE", 0))
+    CACHE_STALE_WHILE_REVALIDATE = os.getenv("CACHE_STALE_WHILE_REVALIDATE", 'false').lower() in ('true', '1', 'yes')
+    CACHE_MAX_STALENESS = int(os.getenv("CACHE_MAX_STALENESS", 24))
+    CACHE_CHAPTER_INDEX_THRESHOLD = int(os.getenv("CACHE_CHAPTER_INDEX_THRESHOLD", 5000))
 
     GROUP_BLACKLIST_FILE = os.getenv("GROUP_BLACKLIST_FILE", 'group_blacklist.txt')
     GROUP_WHITELIST_FILE = os.getenv("GROUP_WHITELIST_FILE", 'group_whitelist.txt')
@@ -26,6 +48,16 @@ class ImpVar:
     USER_WHITELIST_FILE = os.getenv("USER_WHITELIST_FILE", 'user_whitelist.txt')
 
     ARCHIVE_EXTENSION = os.getenv("ARCHIVE_EXTENSION", 'cbz')
+    ARCHIVE_IMAGE_COMPRESSION = os.getenv("ARCHIVE_IMAGE_COMPRESSION", 'store').lower()
+    ARCHIVE_COMPRESSION_LEVEL = int(os.getenv("ARCHIVE_COMPRESSION_LEVEL", 6))
+    ARCHIVE_SAMPLE_PAGES = int(os.getenv("ARCHIVE_SAMPLE_PAGES", 3))
+    ARCHIVE_DEFLATE_RATIO = float(os.getenv("ARCHIVE_DEFLATE_RATIO", 0.9))
+    CPU_WORKERS = int(os.getenv("CPU_WORKERS", 0))
+    PAGE_DEDUP = os.getenv("PAGE_DEDUP", 'off').lower()
+    DURABILITY = os.getenv("DURABILITY", 'none').lower()
+    DURABILITY_BATCH = int(os.getenv("DURABILITY_BATCH", 10))
+    DATA_JOURNAL_COMPACT = int(os.getenv("DATA_JOURNAL_COMPACT", 200))
+    LIBRARY_INDEX = os.getenv("LIBRARY_INDEX", 'true').lower() in ('true', '1', 'yes')
 
     MANGADEX_URL = '{}://{}.{}'.format(scheme, domain, tld)
     MANGADEX_API_URL = '{}://api.{}.{}'.format(scheme, domain, tld)
@@ -46,6 +78,8 @@ class ImpVar:
         r'(?::\d+)?' # optional port
         r'(?:/?|[/?]\S+)$', re.IGNORECASE)
 
+    IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+
     CHARA_REGEX = r'[\\\\/:*?"<>|]'
     UUID_REGEX = r'[0-9a-fA-F]{8}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{4}\-[0-9a-fA-F]{12}'
     FILE_NAME_REGEX = r'(?P<title>.+?)(?:\s\[(?P<language>[a-zA-Z]+)\])?\s-\s(?P<prefix>[c-z])?(?P<chapter>\S+)(?:\s\((?:v)(?P<volume>\S+?)\))?\s?(?:.+)(?:\[(?P<group>.+)\])(?:\{(?:v)(?P<version>\d)\})?(?:\.(?P<extension>zip|cbz))?'
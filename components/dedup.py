@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+import hashlib
+import os
+import threading
+import zipfile
+from pathlib import Path
+from typing import Tuple
+
+from .constants import ImpVar
+from .errors import MDownloaderError
+
+try:
+    import fcntl
+except ModuleNotFoundError:
+    fcntl = None
+
+
+# Linux ioctl that makes the destination share the source's data blocks
+FICLONE = 0x40049409
+
+
+
+class PageStore:
+    """A content-addressed store that identical pages are linked to instead of written again.
+
+    Each unique page is saved once in the store, folder downloads get a hardlink or reflink
+    to it. Filesystems that support neither get a normal copy.
+
+    Args:
+        root (Path): The store folder, it needs to be on the same filesystem as the downloads.
+        mode (str, optional): hardlink or reflink. Defaults to 'hardlink'.
+
+    Raises:
+        MDownloaderError: The dedup mode isn't allowed.
+    """
+
+    def __init__(self, root: Path, mode: str='hardlink') -> None:
+        if mode not in ('hardlink', 'reflink'):
+            raise MDownloaderError("This page dedup mode is not allowed.")
+
+        self.root = root
+        self.mode = mode
+
+    def _store_path(self, data: bytes, suffix: str) -> Path:
+        digest = hashlib.blake2b(data, digest_size=20).hexdigest()
+        return self.root.joinpath(digest[:2], f'{digest}{suffix}')
+
+    def _reflink(self, source: Path, destination: Path) -> bool:
+        """Clone the file's data blocks, only supported on copy-on-write filesystems like btrfs and xfs."""
+        if fcntl is None:
+            return False
+
+        try:
+            with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+            return True
+        except OSError:
+            destination.unlink(missing_ok=True)
+            return False
+
+    def save(self, path: Path, data: bytes) -> None:
+        """Save the page, linking it to the stored copy if the same page was saved before.
+
+        Args:
+            path (Path): Where to save the page.
+            data (bytes): The page's data.
+        """
+        stored_path = self._store_path(data, path.suffix)
+
+        if not stored_path.exists():
+            stored_path.parent.mkdir(parents=True, exist_ok=True)
+            part_path = stored_path.with_name(f'{stored_path.name}.{os.getpid()}.{threading.get_ident()}.part')
+            with open(part_path, 'wb') as part_file:
+                part_file.write(data)
+            os.replace(part_path, stored_path)
+
+        path.unlink(missing_ok=True)
+
+        if self.mode == 'hardlink':
+            try:
+                os.link(stored_path, path)
+                return
+            except OSError:
+                pass
+
+        if self._reflink(stored_path, path):
+            return
+
+        with open(path, 'wb') as page_file:
+            page_file.write(data)
+
+
+def prune_page_store(directory: str) -> Tuple[int, int]:
+    """Delete the stored pages no download is linked to anymore.
+
+    A stored page that's only linked to itself has had every copy of it deleted. Reflinked
+    copies don't share the stored file, so in reflink mode every stored page is deleted,
+    the copies keep their data and the store starts again with the next download.
+
+    Args:
+        directory (str): The download folder.
+
+    Returns:
+        Tuple[int, int]: The number of pages deleted and their size in bytes.
+    """
+    store_root = os.path.join(directory, '.pages')
+    deleted = 0
+    freed = 0
+
+    for root, _, files in os.walk(store_root, topdown=False):
+        for file_name in files:
+            # Pages still being saved by another download
+            if file_name.endswith('.part'):
+                continue
+
+            page_path = os.path.join(root, file_name)
+            try:
+                stat = os.stat(page_path)
+                if stat.st_nlink > 1:
+                    continue
+                os.unlink(page_path)
+            except OSError:
+                continue
+            deleted += 1
+            freed += stat.st_size
+
+        if root != store_root:
+            try:
+                os.rmdir(root)
+            except OSError:
+                pass
+
+    print(f'Removed {deleted} unused stored pages, freeing {freed / 1024 / 1024:.2f} MB.')
+    return deleted, freed
+
+
+def dedup_report(directory: str, top: int=10) -> dict:
+    """Find the pages repeated across the archives in the download folder.
+
+    Pages are matched by the crc and size in each archive's central directory, so no page is decompressed.
+
+    Args:
+        directory (str): The download folder.
+        top (int, optional): How many of the most repeated pages to show. Defaults to 10.
+
+    Returns:
+        dict: The number of archives and pages scanned, the duplicate pages and the bytes they take up.
+    """
+    pages = {}
+    archives = 0
+
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            if not file_name.endswith(('.zip', '.cbz')):
+                continue
+
+            archive_path = os.path.join(root, file_name)
+            try:
+                with zipfile.ZipFile(archive_path) as archive:
+                    members = archive.infolist()
+            except (zipfile.BadZipFile, OSError):
+                print(f'Skipping {archive_path}, it is not a valid archive.')
+                continue
+
+            archives += 1
+            for member in members:
+                if member.filename.lower().endswith(ImpVar.IMAGE_EXTENSIONS):
+                    pages.setdefault((member.CRC, member.file_size), []).append((archive_path, member.filename, member.compress_size))
+
+    page_count = sum(len(p) for p in pages.values())
+    total_bytes = sum(m[2] for p in pages.values() for m in p)
+    repeated = [p for p in pages.values() if len(p) > 1]
+    duplicate_pages = sum(len(p) - 1 for p in repeated)
+    duplicate_bytes = sum(m[2] for p in repeated for m in p[1:])
+    ratio = (duplicate_bytes / total_bytes * 100) if total_bytes else 0
+
+    print(f'Archives: {archives}, pages: {page_count}, unique pages: {len(pages)}')
+    print(f'Duplicate pages: {duplicate_pages}, taking up {duplicate_bytes / 1024 / 1024:.2f} MB ({ratio:.1f}% of the page data)')
+
+    for copies in sorted(repeated, key=lambda p: len(p), reverse=True)[:top]:
+        archive_path, page_name, _ = copies[0]
+        print(f'{len(copies)} copies: {page_name} in {os.path.relpath(archive_path, directory)}')
+
+    return {
+        "archives": archives,
+        "pages": page_count,
+        "unique_pages": len(pages),
+        "duplicate_pages": duplicate_pages,
+        "duplicate_bytes": duplicate_bytes}
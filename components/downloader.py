@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 import math
 from datetime import datetime
+from functools import partial
+from typing import Tuple
 
 from .image_downloader import chapter_downloader
 from .errors import MDownloaderError, NotLoggedInError
@@ -8,15 +10,27 @@ from .jsonmaker import BulkJson, TitleJson
 from .model import MDownloader
 
 
-def download_chapters(md_model: MDownloader, chapters: list, chapters_data: list) -> None:
+def download_chapters(md_model: MDownloader, chapters: list, chapters_data: set) -> None:
     """Loop chapters and call the baseDownloader function.
 
     Args:
         chapters (list): The chapters to download.
-        chapters_data (list): The ids of the downloaded chapters from the data json.
+        chapters_data (set): The ids of the downloaded chapters from the data json.
     """
+    # Streamed chapters aren't saved, so they're always sent again
+    library = md_model.library if md_model.args.stream is None and not md_model.force_refresh else None
+    download_format = 'folder' if md_model.args.folder_download else 'archive'
+
     for chapter in chapters:
         chapter_id = chapter["id"]
+        if chapter_id in chapters_data:
+            continue
+        if library is not None and library.has(chapter_id, download_format, chapter["attributes"].get("hash")):
+            # Saved elsewhere in the library, keep the data json in step with it
+            md_model.exist.add_to_json(chapter)
+            md_model.exist.save_json()
+            continue
+
         md_model.chapter_id = chapter_id
         md_model.chapter_data = chapter
 
@@ -25,13 +39,24 @@ def download_chapters(md_model: MDownloader, chapters: list, chapters_data: list
             md_model.formatter.format_title(manga_data)
 
         try:
-            if chapter_id not in chapters_data:
-                chapter_downloader(md_model)
-                md_model.wait(1)
+            chapter_downloader(md_model)
+            md_model.wait(1)
         except MDownloaderError as e:
             if e: print(e)
 
 
+def feed_parameters(md_model: MDownloader) -> dict:
+    """The parameters the chapter feed is requested with, the feed is cached under them."""
+    parameters = {"translatedLanguage[]": md_model.args.language, "contentRating[]": ["safe","suggestive","erotica", "pornographic"]}
+    parameters.update(md_model.params)
+    return parameters
+
+
+def entity_request(md_model: MDownloader, download_type: str, download_id: str) -> Tuple[str, dict]:
+    """The url and parameters a group, user or list is requested with, the cached data has these includes."""
+    return f'{md_model.api_url}/{download_type}/{download_id}', {"includes[]": ["user", "leader", "member"]}
+
+
 def get_chapters(md_model: MDownloader, url: str) -> list:
     """Go through each page in the api to get all the chapters.
 
@@ -48,8 +73,7 @@ def get_chapters(md_model: MDownloader, url: str) -> list:
     iteration = 1
     created_at_since_time = '2000-01-01T00:00:00'
 
-    parameters = {"translatedLanguage[]": md_model.args.language, "contentRating[]": ["safe","suggestive","erotica", "pornographic"]}
-    parameters.update(md_model.params)
+    parameters = feed_parameters(md_model)
 
     while True:
         # Update the parameters with the new offset
@@ -110,16 +134,16 @@ def manga_download(md_model: MDownloader) -> None:
     download_type = md_model.download_type
 
     cache_json = md_model.cache.load_cache(manga_id)
-    refresh_cache = md_model.cache.check_cache_time(cache_json)
+    refresh_cache = md_model.cache.check_cache_time(cache_json, manga_id, partial(md_model.api.get_manga_data, download_type, manga_id))
     manga_data = cache_json.get('data', {})
 
     if md_model.manga_data and md_model.args.search_manga:
         manga_data = md_model.manga_data
-        md_model.cache.save_cache(datetime.now(), manga_id, data=manga_data)
+        md_model.cache.save_cache(datetime.now(), manga_id, data=manga_data, kind='manga')
 
     if refresh_cache or not manga_data:
-        manga_data = md_model.api.get_manga_data(download_type)
-        md_model.cache.save_cache(datetime.now(), manga_id, data=manga_data)
+        manga_data = md_model.api.get_manga_data(download_type, manga_id)
+        md_model.cache.save_cache(datetime.now(), manga_id, data=manga_data, kind='manga')
         md_model.wait()
 
     md_model.manga_data = manga_data
@@ -128,36 +152,57 @@ def manga_download(md_model: MDownloader) -> None:
     title_json = TitleJson(md_model)
     md_model.title_json = title_json
 
+    chapter_index = None
     if md_model.type_id == 1:
         chapters_data = title_json.downloaded_ids
-        chapters = cache_json.get("chapters", [])
+        md_model.params = {"order[chapter]": "desc", "order[volume]": "desc"}
+        feed_id = md_model.cache.feed_key(manga_id, feed_parameters(md_model))
+        # Large chapter lists are filtered on the chapter index, only the chapters left are built
+        feed_json = md_model.cache.load_cache(feed_id, materialise=False)
+        if md_model.cache.check_cache_time(feed_json):
+            feed_json = {}
 
-        if not chapters:
+        chapters = feed_json.get("chapters", [])
+        chapter_index = md_model.cache.chapter_index(feed_id) if 'chapter_index' in feed_json else None
+
+        if not chapters and chapter_index is None:
             # Call the api and filter out languages other than the selected
-            md_model.params = {"order[chapter]": "desc", "order[volume]": "desc"}
             url = f'{md_model.manga_api_url}/{md_model.id}'
             chapters = get_chapters(md_model, url)
-            md_model.cache.save_cache(datetime.now(), manga_id, data=manga_data, chapters=chapters)
+            md_model.cache.save_cache(datetime.now(), feed_id, chapters=chapters, kind='feed')
             md_model.wait()
 
         md_model.chapters_data = chapters
-        md_model.chapter_prefix_dict = md_model.title_misc.get_prefixes(chapters)
+        if chapter_index is not None:
+            md_model.chapter_prefix_dict = md_model.title_misc.get_index_prefixes(chapter_index)
+        else:
+            md_model.chapter_prefix_dict = md_model.title_misc.get_prefixes(chapters)
     else:
         chapters = md_model.chapters_data[manga_id]["chapters"]
         chapters_data = md_model.bulk_json.downloaded_ids
         download_type = f'{download_type}-manga'
 
-    chapters = md_model.filter.filter_chapters(chapters)
+    if chapter_index is not None:
+        rows = md_model.filter.filter_index(chapter_index)
+    else:
+        chapters = md_model.filter.filter_chapters(chapters)
     md_model.misc.download_message(0, download_type, title)
 
     if md_model.args.range_download and md_model.type_id == 1:
-        chapters = md_model.title_misc.download_range_chapters(chapters)
+        if chapter_index is not None:
+            rows = md_model.title_misc.download_range_index(chapter_index, rows)
+        else:
+            chapters = md_model.title_misc.download_range_chapters(chapters)
+
+    if chapter_index is not None:
+        chapters = chapter_index.chapters(rows)
 
     download_chapters(md_model, chapters, chapters_data)
     md_model.misc.download_message(1, download_type, title)
 
     # Save the json and covers if selected
     title_json.core(1)
+    md_model.cache.flush()
 
 
 def bulk_download(md_model: MDownloader) -> None:
@@ -170,10 +215,10 @@ def bulk_download(md_model: MDownloader) -> None:
         data = cache_json.get('data', {})
 
         if refresh_cache or not data:
-            response = md_model.api.request_data(f'{md_model.api_url}/{md_model.download_type}/{md_model.id}', **{"includes[]": ["user", "leader", "member"]})
-            data = md_model.api.convert_to_json(md_model.id, download_type, response)
+            entity_url, entity_params = entity_request(md_model, download_type, md_model.id)
+            data = md_model.api.get_entity_data(md_model.id, download_type, entity_url, **entity_params)
 
-            md_model.cache.save_cache(datetime.now(), download_id=md_model.id, data=data)
+            md_model.cache.save_cache(datetime.now(), download_id=md_model.id, data=data, kind=download_type)
             md_model.wait()
 
         # Order the chapters descending by the order they're released to read
@@ -184,7 +229,6 @@ def bulk_download(md_model: MDownloader) -> None:
     else:
         download_id = f'{md_model.id}-follows'
         url = f'{md_model.user_api_url}/follows/manga'
-        cache_json = md_model.cache_json
 
     name_path = md_model.data["attributes"]
     md_model.params.update({"includes[]": ["manga"]})
@@ -206,11 +250,22 @@ def bulk_download(md_model: MDownloader) -> None:
         md_model.name = f"{owner}'s Follows List"
 
     md_model.misc.download_message(0, download_type, md_model.name)
-    chapters = cache_json.get('chapters', [])
+    feed_id = md_model.cache.feed_key(download_id, feed_parameters(md_model))
+
+    if md_model.type_id == 2:
+        # Large chapter lists are read from the chapter index further down
+        feed_json = md_model.cache.load_cache(feed_id, materialise=False)
+        if md_model.cache.check_cache_time(feed_json):
+            feed_json = {}
+    else:
+        feed_json = md_model.cache_json
+
+    chapters = feed_json.get('chapters', [])
+    chapter_index = md_model.cache.chapter_index(feed_id) if 'chapter_index' in feed_json else None
 
-    if not chapters:
+    if not chapters and chapter_index is None:
         chapters = get_chapters(md_model, url)
-        md_model.cache.save_cache(datetime.now(), download_id, md_model.data, chapters)
+        md_model.cache.save_cache(datetime.now(), feed_id, chapters=chapters, kind='feed')
         md_model.wait()
 
     # Initalise json classes and make series folders
@@ -221,6 +276,12 @@ def bulk_download(md_model: MDownloader) -> None:
         print(f"Getting each manga's data from the {download_type} chosen.")
 
         titles = {}
+        if chapter_index is not None:
+            # Only build the chapters left after filtering
+            rows = md_model.filter.filter_index(chapter_index)
+            for manga_id, manga_rows in chapter_index.rows_by_manga(rows).items():
+                titles[manga_id] = {"mangaId": manga_id, "chapters": chapter_index.chapters(manga_rows)}
+
         for chapter in chapters:
             manga_id = [c["id"] for c in chapter["relationships"] if c["type"] == 'manga'][0]
             if manga_id in titles:
@@ -243,13 +304,17 @@ def bulk_download(md_model: MDownloader) -> None:
             md_model.wait(0)
     else:
         chapters_data = bulk_json.downloaded_ids
-        chapters = md_model.filter.filter_chapters(chapters)
+        if chapter_index is not None:
+            chapters = chapter_index.chapters(md_model.filter.filter_index(chapter_index))
+        else:
+            chapters = md_model.filter.filter_chapters(chapters)
         download_chapters(md_model, chapters, chapters_data)
 
     md_model.misc.download_message(1, download_type, md_model.name)
 
     # Save the json
     bulk_json.core(1)
+    md_model.cache.flush()
 
 
 def follows_download(md_model: MDownloader) -> None:
@@ -275,13 +340,12 @@ def chapter_download(md_model: MDownloader) -> None:
     download_type = md_model.download_type
 
     cache_json = md_model.cache.load_cache(chapter_id)
-    refresh_cache = md_model.cache.check_cache_time(cache_json)
+    refresh_cache = md_model.cache.check_cache_time(cache_json, chapter_id, partial(md_model.api.get_chapter_data, download_type, chapter_id))
     chapter_data = cache_json.get('data', {})
 
     if refresh_cache or not chapter_data:
-        response = md_model.api.request_data(f'{md_model.chapter_api_url}/{chapter_id}', **{"includes[]": ["manga", "scanlation_group"]})
-        chapter_data = md_model.api.convert_to_json(chapter_id, download_type, response)
-        md_model.cache.save_cache(datetime.now(), chapter_id, data=chapter_data)
+        chapter_data = md_model.api.get_chapter_data(download_type, chapter_id)
+        md_model.cache.save_cache(datetime.now(), chapter_id, data=chapter_data, kind='chapter')
 
     manga_data = md_model.misc.check_manga_data(chapter_data)
     md_model.data = md_model.manga_data = manga_data
@@ -292,5 +356,6 @@ def chapter_download(md_model: MDownloader) -> None:
     md_model.misc.download_message(0, download_type, name)
 
     chapter_downloader(md_model)
+    md_model.cache.flush()
 
     md_model.misc.download_message(1, download_type, name)
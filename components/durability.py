@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+import os
+import threading
+from pathlib import Path
+from typing import Union
+
+from .errors import MDownloaderError
+
+
+
+def fsync_path(path: Union[str, Path]) -> None:
+    """Flush the file or folder to the disk, folders can't be opened on Windows so they're skipped."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+
+class DurabilityPolicy:
+    """Decides when the downloaded files are flushed to the disk.
+
+    none leaves it to the OS, chapter flushes each chapter's files when it's finished and
+    batch flushes the files of every N chapters together. Each file's folder is flushed
+    after it, so renamed and new files are kept too.
+
+    Args:
+        mode (str, optional): none, chapter or batch. Defaults to 'none'.
+        batch_size (int, optional): How many chapters batch waits for. Defaults to 10.
+
+    Raises:
+        MDownloaderError: The durability mode isn't allowed.
+    """
+
+    def __init__(self, mode: str='none', batch_size: int=10) -> None:
+        if mode not in ('none', 'chapter', 'batch'):
+            raise MDownloaderError("This durability mode is not allowed.")
+
+        self.mode = mode
+        self.batch_size = max(batch_size, 1)
+        self._pending = set()
+        self._chapters = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # Other processes get their own lock, the files pending are flushed by this one
+        return {**self.__dict__, "_pending": set(), "_lock": None}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def written(self, path: Union[str, Path]) -> None:
+        """Mark the file to be flushed with the current chapter."""
+        if self.mode == 'none':
+            return
+
+        path = Path(path)
+        with self._lock:
+            self._pending.add(path)
+            self._pending.add(path.parent)
+
+    def before_rename(self, path: Union[str, Path]) -> None:
+        """Flush the file before it replaces another in chapter mode, so the new name never points at missing data."""
+        if self.mode == 'chapter':
+            fsync_path(path)
+
+    def chapter_done(self) -> None:
+        """Flush the pending files if the chapter finishes the batch."""
+        if self.mode == 'none':
+            return
+
+        with self._lock:
+            self._chapters += 1
+            due = self.mode == 'chapter' or self._chapters % self.batch_size == 0
+
+        if due:
+            self.sync()
+
+    def sync(self) -> None:
+        """Flush every pending file, then their folders."""
+        with self._lock:
+            paths, self._pending = self._pending, set()
+
+        for path in sorted(paths, key=lambda p: p.is_dir()):
+            fsync_path(path)
@@ -27,6 +27,7 @@ class MDRequestError(MDownloaderError):
                 response: Response,
                 data: dict={}) -> None:
 
+        self.status_code = response.status_code
         http_error_codes = {"400": "Bad request.", "401": "Unauthorised.", "403": "Forbidden.", "404": "Not found.", "429": "Too many requests."}
 
         if data:
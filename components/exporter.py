@@ -1,15 +1,30 @@
 #!/usr/bin/python3
 import json
 import os
+import queue
 import re
 import shutil
+import threading
 import zipfile
+import zlib
+from concurrent.futures import Future
 from datetime import datetime
+from functools import partial
 from pathlib import Path
+from typing import Optional, Tuple, Union
 
+from .archive import deflate, read_comment, recover_archive, write_compressed
+from .constants import ImpVar
+from .dedup import PageStore
 from .errors import MDownloaderError
 from .languages import get_lang_iso
 from .model import MDownloader
+from .workers import get_pool
+
+# Tells the writer thread to write every page it's holding back
+_FLUSH = object()
+# Stands in for a page that couldn't be prepared, it's skipped like a failed download
+_FAILED = object()
 
 
 
@@ -37,7 +52,130 @@ class ExporterBase:
         self.add_data = md_model.args.save_chapter_data
         self.destination = md_model.route
         self.path = Path(md_model.route)
-        self.path.mkdir(parents=True, exist_ok=True)
+        if md_model.args.stream is None:
+            self.path.mkdir(parents=True, exist_ok=True)
+
+        # The files in the archive or folder, seeded once it's opened and kept up to date as files are added
+        self.names = set()
+        self.pages = set()
+        self.expected_pages = 0
+
+        # Pages are written on their own thread so the downloads don't wait on the disk
+        self._queue = queue.Queue()
+        self._writer = None
+
+    def _seed_names(self, names: list) -> None:
+        """Fill the name sets with the files already in the archive or folder."""
+        self.names = set()
+        self.pages = set()
+        for name in names:
+            self._add_name(name)
+
+    def _add_name(self, name: str) -> None:
+        self.names.add(name)
+        if name.endswith(ImpVar.IMAGE_EXTENSIONS):
+            self.pages.add(name)
+
+    def page_count(self) -> int:
+        """How many images are in the archive or folder, after the queued pages are written."""
+        self.flush()
+        return len(self.pages)
+
+    def is_complete(self, page_count: int) -> bool:
+        """Check if the number of images in the archive or folder match that of the API.
+
+        Args:
+            page_count (int): How many pages the chapter has.
+        """
+        self.expected_pages = page_count
+        return self.page_count() == page_count
+
+    def _record_download(self, path: Union[str, Path], download_format: str, size: int) -> None:
+        """Add the finished download to the library index."""
+        if self.md_model.library is not None:
+            self.md_model.library.record(self.chapter_id, self.chapter_data.get("hash"), path, download_format, self.expected_pages, size)
+
+    def _prepare_page(self, page_name: str, response: bytes) -> Union[bytes, Future]:
+        """Start any work the page needs before it's written, as soon as it's downloaded."""
+        return response
+
+    def _write_page(self, page_name: str, response: Union[bytes, Future]) -> None:
+        raise NotImplementedError
+
+    def _write_pages(self) -> None:
+        """Write the queued pages in page order.
+
+        Pages that finish downloading early are held until the pages before them arrive,
+        a flush writes whatever is left.
+        """
+        waiting = {}
+        next_page = 1
+
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+
+                if item is _FLUSH:
+                    ready = sorted(waiting)
+                else:
+                    page_no, page_name, response = item
+                    # A page that can't be prepared still takes its place in the order, so the pages after it aren't held back
+                    try:
+                        if page_name not in self.names:
+                            response = self._prepare_page(page_name, response)
+                    except Exception as e:
+                        print(e)
+                        response = _FAILED
+                    waiting[page_no] = (page_name, response)
+                    ready = []
+                    while next_page in waiting:
+                        ready.append(next_page)
+                        next_page += 1
+
+                for page_no in ready:
+                    page_name, response = waiting.pop(page_no)
+                    next_page = max(next_page, page_no + 1)
+                    # Errors are reported like a failed download, the page is missing from the count
+                    try:
+                        if response is not _FAILED and page_name not in self.names:
+                            self._write_page(page_name, response)
+                    except Exception as e:
+                        print(e)
+            finally:
+                self._queue.task_done()
+
+    def add_image(self, response: bytes, page_no: int, ext: str, orig_name: str) -> None:
+        """Format the image name then queue it to be saved.
+
+        Args:
+            response (bytes): The image data.
+            page_no (int): The image number.
+            ext (str): The image extension.
+            orig_name (str): The original image name.
+        """
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_pages, name=f'writer-{self.chapter_id}', daemon=True)
+            self._writer.start()
+
+        self._queue.put((page_no, self._format_page_name(page_no, ext, orig_name), response))
+
+    def flush(self) -> None:
+        """Wait for the queued pages to be written."""
+        if self._writer is None:
+            return
+        self._queue.put(_FLUSH)
+        self._queue.join()
+
+    def _stop_writer(self) -> None:
+        """Write the queued pages and stop the writer thread."""
+        if self._writer is None:
+            return
+        self.flush()
+        self._queue.put(None)
+        self._writer.join()
+        self._writer = None
 
     def _process_data(self):
         """Convert the chapter data into a more readable format."""
@@ -113,21 +251,20 @@ class ExporterBase:
             group_id = group["id"]
             group_data = group.get('attributes', {})
             cache_json = self.md_model.cache.load_cache(group_id)
-            refresh_cache = self.md_model.cache.check_cache_time(cache_json)
 
             if not group_data:
                 if self.md_model.debug: print('Calling api for group data from chapter download.')
+                refresh_cache = self.md_model.cache.check_cache_time(cache_json, group_id, partial(self.md_model.api.get_group_data, 'chapter-group', group_id))
                 group_data = cache_json.get('data', {})
 
                 if refresh_cache or not group_data:
-                    group_response = self.md_model.api.request_data(f'{self.md_model.group_api_url}/{group_id}')
-                    group_data = self.md_model.api.convert_to_json(group_id, 'chapter-group', group_response)
-                    self.md_model.cache.save_cache(datetime.now(), group_id, group_data)
+                    group_data = self.md_model.api.get_group_data('chapter-group', group_id)
+                    self.md_model.cache.save_cache(datetime.now(), group_id, group_data, kind='group')
 
                 group_data = group_data["attributes"]
             else:
-                if refresh_cache:
-                    self.md_model.cache.save_cache(cache_json.get('cache_date', ''), download_id=group_id, data=group, chapters=cache_json.get('chapters', []), covers=cache_json.get('covers', []))
+                if self.md_model.cache.check_cache_time(cache_json):
+                    self.md_model.cache.save_cache(cache_json.get('cache_date', ''), download_id=group_id, data=group, kind='group')
 
             name = group_data["name"]
             group_names.append(name)
@@ -186,13 +323,89 @@ class ExporterBase:
 
 
 
+class CompressionPolicy:
+    """Picks how each archive entry is compressed.
+
+    Images are stored as they are unless the image mode is deflate, or auto finds the
+    first pages shrink enough when compressed. Everything else is deflated.
+
+    Args:
+        image_mode (str, optional): store, deflate or auto. Defaults to 'store'.
+        level (int, optional): The deflate level. Defaults to 6.
+        sample_pages (int, optional): How many pages auto compresses before deciding. Defaults to 3.
+        deflate_ratio (float, optional): The compressed to original size ratio auto needs to keep deflating. Defaults to 0.9.
+
+    Raises:
+        MDownloaderError: The image compression mode isn't allowed.
+    """
+
+    def __init__(self, image_mode: str='store', level: int=6, sample_pages: int=3, deflate_ratio: float=0.9) -> None:
+        if image_mode not in ('store', 'deflate', 'auto'):
+            raise MDownloaderError("This archive image compression is not allowed.")
+
+        self.image_mode = image_mode
+        self.level = level
+        self.sample_pages = sample_pages
+        self.deflate_ratio = deflate_ratio
+        self._original_size = 0
+        self._compressed_size = 0
+        self._sampled = 0
+
+    def _sample(self, data: bytes) -> bool:
+        """Compress the page to see if it's worth it, once enough pages are sampled the mode is fixed."""
+        compressed_size = len(zlib.compress(data, self.level))
+        self._original_size += len(data)
+        self._compressed_size += compressed_size
+        self._sampled += 1
+
+        if self._sampled >= self.sample_pages:
+            worth_it = self._compressed_size <= self._original_size * self.deflate_ratio
+            self.image_mode = 'deflate' if worth_it else 'store'
+        return compressed_size <= len(data) * self.deflate_ratio
+
+    def compression(self, name: str, data: bytes) -> Tuple[int, Optional[int]]:
+        """The compression type and level to add the entry with.
+
+        Args:
+            name (str): The entry's name in the archive.
+            data (bytes): The entry's data.
+
+        Returns:
+            Tuple[int, Optional[int]]: The zipfile compression type and level.
+        """
+        if not name.lower().endswith(ImpVar.IMAGE_EXTENSIONS):
+            deflate = True
+        elif self.image_mode == 'auto':
+            deflate = bool(data) and self._sample(data)
+        else:
+            deflate = self.image_mode == 'deflate'
+
+        if deflate:
+            return zipfile.ZIP_DEFLATED, self.level
+        return zipfile.ZIP_STORED, None
+
+
+
 class ArchiveExporter(ExporterBase):
     def __init__(self, md_model: MDownloader) -> None:
         super().__init__(md_model)
 
+        self.compression_policy = CompressionPolicy(
+            ImpVar.ARCHIVE_IMAGE_COMPRESSION,
+            ImpVar.ARCHIVE_COMPRESSION_LEVEL,
+            ImpVar.ARCHIVE_SAMPLE_PAGES,
+            ImpVar.ARCHIVE_DEFLATE_RATIO)
         self.archive_extension = md_model.args.archive_extension
         self.archive_path = os.path.join(self.destination, f'{self.folder_name}.{self.archive_extension}')
+        self.finished_pages = None
         self.archive = self._check_zip()
+        if self.archive is not None:
+            self._seed_names(self.archive.namelist())
+
+    @property
+    def part_path(self) -> str:
+        """Where the archive is written to until it's finished."""
+        return f'{self.archive_path}.part'
 
     def _make_zip(self) -> zipfile.ZipFile:
         """Make a zipfile, if it exists, open it instead.
@@ -205,87 +418,187 @@ class ArchiveExporter(ExporterBase):
             zipfile.ZipFile: A ZipFile object of the open archive.
         """
         try:
-            return zipfile.ZipFile(self.archive_path, mode="a", compression=zipfile.ZIP_DEFLATED)
+            # Each entry's compression is picked when it's added
+            return zipfile.ZipFile(self.part_path, mode="a", compression=zipfile.ZIP_STORED)
         except zipfile.BadZipFile:
             raise MDownloaderError('Error creating archive')
         except PermissionError:
             raise MDownloaderError("The file is open by another process.")
 
-    def _check_zip(self) -> zipfile.ZipFile:
-        """Check if the zipfile is a duplicate."""
+    def _comment(self) -> str:
+        """The archive comment, the chapter hash is always the last line."""
+        return f'{self.chapter_id}\n{self.chapter_data["title"]}\n{self.expected_pages}\n{self.chapter_data["hash"]}'
+
+    def _check_zip(self) -> Optional[zipfile.ZipFile]:
+        """Find the archive to save the chapter to.
+
+        Finished archives are only read for their comment, one with the same chapter hash
+        isn't opened at all. Archives are written to a .part file until every page is saved,
+        a .part file from an earlier run with the same hash is carried on from.
+
+        Returns:
+            Optional[zipfile.ZipFile]: The open .part archive, None if the chapter's archive is finished.
+        """
         version_no = 1
-        self.archive = self._make_zip()
-        chapter_hash = self.archive.comment.decode().split('\n')[-1]
-        to_add = f'{self.chapter_id}\n{self.chapter_data["title"]}\n{self.chapter_data["hash"]}'
-
-        if chapter_hash == '' or chapter_hash == self.chapter_data["hash"]:
-            if self.archive.comment.decode() != to_add:
-                self.archive.comment = to_add.encode()
-            return self.archive
-        else:
-            self.close()
-            version_no += 1
 
-            print('The archive with the same chapter number and groups exists, but not the same chapter hash, making a different archive...')
-
-            # Loop until an available archive name that isn't taken is available
-            while True:
-                if os.path.exists(self.archive_path):
-                    self.archive_path = os.path.join(self.destination, f'{self.folder_name}{{v{version_no}}}.{self.archive_extension}')
-                    self.archive = self._make_zip()
-                    chapter_hash = self.archive.comment.decode().split('\n')[-1]
-                    if chapter_hash == '' or chapter_hash == self.chapter_data["hash"]:
-                        break
-                    else:
-                        self.close()
-                        version_no += 1
-                else:
-                    break
+        # Loop until an available archive name that isn't taken is available
+        while True:
+            try:
+                comment = read_comment(self.archive_path)
+            except zipfile.BadZipFile:
+                # Broken archives are carried on from like a .part file
+                os.replace(self.archive_path, self.part_path)
+                break
+            if comment is None:
+                break
+
+            comment_lines = comment.split('\n')
+            if comment_lines[-1] in ('', self.chapter_data["hash"]):
+                if len(comment_lines) == 4 and comment_lines[2].isdigit():
+                    self.finished_pages = int(comment_lines[2])
+                    return None
+
+                # Archives made before .part files were used are finished off as one
+                os.replace(self.archive_path, self.part_path)
+                break
+
+            if version_no == 1:
+                print('The archive with the same chapter number and groups exists, but not the same chapter hash, making a different archive...')
+            version_no += 1
+            self.archive_path = os.path.join(self.destination, f'{self.folder_name}{{v{version_no}}}.{self.archive_extension}')
 
-            self.archive.comment = to_add.encode()
-            return self.archive
+        try:
+            part_comment = read_comment(self.part_path)
+        except zipfile.BadZipFile:
+            # Left behind by a crash before the archive was closed, keep the pages that were fully written
+            recover_archive(self.part_path)
+            part_comment = read_comment(self.part_path)
+
+        if part_comment is not None and part_comment.split('\n')[-1] not in ('', self.chapter_data["hash"]):
+            os.remove(self.part_path)
+
+        archive = self._make_zip()
+        archive.comment = self._comment().encode()
+        return archive
+
+    def is_complete(self, page_count: int) -> bool:
+        """Check the archive has all the chapter's pages, a finished archive is checked from its comment."""
+        if self.archive is None:
+            if self.finished_pages == page_count:
+                self.expected_pages = page_count
+                return True
 
-    def _compress_image(self) -> None:
-        """Add image to archive through the memory."""
-        self.archive.writestr(self.page_name, self.response)
+            # The finished archive doesn't match the chapter anymore, carry on from it
+            os.replace(self.archive_path, self.part_path)
+            self.archive = self._make_zip()
+            self._seed_names(self.archive.namelist())
+        return super().is_complete(page_count)
+
+    def _compress(self, name: str, data: bytes) -> Tuple[int, Optional[int], Union[bytes, Future]]:
+        """Pick the entry's compression, deflated entries are compressed on the process pool if there is one."""
+        compress_type, compress_level = self.compression_policy.compression(name, data)
+        pool = get_pool()
+        if pool is not None and compress_type == zipfile.ZIP_DEFLATED:
+            return compress_type, compress_level, pool.submit(deflate, data, compress_level)
+        return compress_type, compress_level, data
+
+    def _write_member(self, name: str, compress_type: int, compress_level: Optional[int], data: Union[bytes, Future]) -> None:
+        """Add the entry to the archive, entries compressed on the process pool are added as they are."""
+        if isinstance(data, Future):
+            write_compressed(self.archive, name, *data.result())
+        else:
+            self.archive.writestr(name, data, compress_type=compress_type, compresslevel=compress_level)
+        self._add_name(name)
 
-    def _check_image(self) -> None:
-        """Check if the image is in the archive, skip if it is."""
-        if self.page_name not in self.archive.namelist():
-            self._compress_image()
+    def _write_entry(self, name: str, data: bytes) -> None:
+        """Add the entry to the archive, compressed as the policy picks."""
+        self._write_member(name, *self._compress(name, data))
 
-    def add_image(self, response: bytes, page_no: int, ext: str, orig_name: str) -> None:
-        """Format the image name then add to archive.
+    def _prepare_page(self, page_name: str, response: bytes) -> tuple:
+        """Pick the page's compression as soon as it's downloaded, so pages are compressed in parallel."""
+        return self._compress(page_name, response)
 
-        Args:
-            response (bytes): The image data.
-            page_no (int): The image number.
-            ext (str): The image extension.
-            orig_name (str): The original image name.
-        """
-        self.page_name = self._format_page_name(page_no, ext, orig_name)
-        self.response = response
+    def _write_page(self, page_name: str, response: tuple) -> None:
+        """Add image to archive through the memory."""
+        self._write_member(page_name, *response)
 
-        self._check_image()
+    def _add_chapter_json(self) -> None:
+        """Add the chapter data json to the archive."""
+        if self.add_data and f'{self.chapter_id}.json' not in self.names:
+            self._write_entry(f'{self.chapter_id}.json', json.dumps(self.orig_chapter_data, indent=4, ensure_ascii=False).encode('utf-8'))
 
     def close(self, status: int=0) -> None:
         """Close the archive and save the chapter data.
 
+        The .part archive replaces the finished archive once it has all the pages.
+
         Args:
             status (int, optional): The type of archive closing. Defaults to 0. 0 doesnt't delete, 1 deletes if empty, 2 deletes regardless.
         """
-        pages = self.archive.namelist()
+        self._stop_writer()
+
+        if self.archive is None:
+            # The finished archive was never opened
+            if status == 2:
+                os.remove(self.archive_path)
+            elif status == 0:
+                self._record_download(self.archive_path, 'archive', os.path.getsize(self.archive_path))
+            return
+
+        pages = bool(self.names)
 
         if status == 0:
-            # Add the chapter data json to the archive
-            if self.add_data and f'{self.chapter_id}.json' not in self.archive.namelist():
-                self.archive.writestr(f'{self.chapter_id}.json', json.dumps(self.orig_chapter_data, indent=4, ensure_ascii=False))
+            self._add_chapter_json()
 
+        self.archive.comment = self._comment().encode()
         self.archive.close()
 
         if status in (1, 2):
             if status == 2 or (status == 1 and not pages):
-                os.remove(self.archive_path)
+                os.remove(self.part_path)
+            return
+
+        if self.expected_pages and len(self.pages) >= self.expected_pages:
+            self.md_model.durability.before_rename(self.part_path)
+            os.replace(self.part_path, self.archive_path)
+            self.md_model.durability.written(self.archive_path)
+            self._record_download(self.archive_path, 'archive', os.path.getsize(self.archive_path))
+        else:
+            self.md_model.durability.written(self.part_path)
+        self.md_model.durability.chapter_done()
+
+
+
+class StreamExporter(ArchiveExporter):
+    """Streams the chapter's archive to stdout or a named pipe instead of saving it."""
+
+    def _check_zip(self) -> zipfile.ZipFile:
+        """Start a new archive on the stream, nothing is read from the disk."""
+        self.stream = self.md_model.args.stream
+        archive = zipfile.ZipFile(self.stream.open(), mode="w", compression=zipfile.ZIP_STORED)
+        archive.comment = self._comment().encode()
+        return archive
+
+    def close(self, status: int=0) -> None:
+        """Finish the archive on the stream and write the chapter's metadata.
+
+        Args:
+            status (int, optional): The type of archive closing. Defaults to 0. Streamed archives can't be deleted, 0 adds the chapter data.
+        """
+        self._stop_writer()
+
+        if status == 0:
+            self._add_chapter_json()
+
+        self.archive.comment = self._comment().encode()
+        self.archive.close()
+        self.stream.close({
+            "chapterId": self.chapter_id,
+            "name": os.path.basename(self.archive_path),
+            "hash": self.chapter_data["hash"],
+            "pages": len(self.pages),
+            "expectedPages": self.expected_pages,
+            "complete": bool(self.expected_pages) and len(self.pages) >= self.expected_pages})
 
 
 
@@ -293,6 +606,9 @@ class FolderExporter(ExporterBase):
     def __init__(self, md_model: MDownloader) -> None:
         super().__init__(md_model)
 
+        self.page_store = None
+        if ImpVar.PAGE_DEDUP != 'off':
+            self.page_store = PageStore(Path(md_model.directory).joinpath('.pages'), ImpVar.PAGE_DEDUP)
         self.check_folder()
 
     def _make_folder(self) -> bool:
@@ -317,6 +633,7 @@ class FolderExporter(ExporterBase):
         """Check if the image is in the folder, skip if it is"""
         self.folder_path = self.path.joinpath(self.folder_name)
         self._make_folder()
+        self._seed_names(os.listdir(self.folder_path))
         # version_no = 1
         # if self.makeFolder():
         #     if f'{self.chapter_id}.json' not in os.listdir(self.folder_path):
@@ -332,29 +649,15 @@ class FolderExporter(ExporterBase):
         #             else:
         #                 break
 
-    def _add_to_folder(self) -> None:
-        """Add images to the folder."""
-        with open(self.folder_path.joinpath(self.page_name), 'wb') as file:
-            file.write(self.response)
-
-    def _check_image(self) -> None:
-        """Check if images are in the folder."""
-        if self.page_name not in os.listdir(self.folder_path):
-            self._add_to_folder()
-
-    def add_image(self, response: bytes, page_no: int, ext: str, orig_name: str) -> None:
-        """Format the image name then add to archive.
-
-        Args:
-            response (bytes): The image data.
-            page_no (int): The image number.
-            ext (str): The image extension.
-            orig_name (str): The original image name.
-        """
-        self.page_name = self._format_page_name(page_no, ext, orig_name)
-        self.response = response
-
-        self._check_image()
+    def _write_page(self, page_name: str, response: bytes) -> None:
+        """Add images to the folder, linked to the identical pages already downloaded if dedup is on."""
+        if self.page_store is not None:
+            self.page_store.save(self.folder_path.joinpath(page_name), response)
+        else:
+            with open(self.folder_path.joinpath(page_name), 'wb') as file:
+                file.write(response)
+        self.md_model.durability.written(self.folder_path.joinpath(page_name))
+        self._add_name(page_name)
 
     def close(self, status: int=0) -> None:
         """Close the archive and save the chapter data.
@@ -362,14 +665,21 @@ class FolderExporter(ExporterBase):
         Args:
             status (int, optional): The type of archive closing. Defaults to 0. 0 doesnt't delete, 1 deletes if empty, 2 deletes regardless.
         """
-        files_path = os.listdir(self.folder_path)
-        pages = [i for i in files_path if i.endswith(('.png', '.jpg', '.jpeg', '.gif'))]
-
+        self._stop_writer()
         if status == 0:
             # Add the chapter data json to the folder
-            if self.add_data and f'{self.chapter_id}.json' not in files_path:
+            if self.add_data and f'{self.chapter_id}.json' not in self.names:
                 with open(self.folder_path.joinpath(f'{self.chapter_id}.json'), 'w') as json_file:
                     json.dump(self.orig_chapter_data, json_file, indent=4, ensure_ascii=False)
+                self.md_model.durability.written(self.folder_path.joinpath(f'{self.chapter_id}.json'))
+                self._add_name(f'{self.chapter_id}.json')
+            self.md_model.durability.written(self.folder_path)
+            self.md_model.durability.chapter_done()
+
+            if self.expected_pages and len(self.pages) >= self.expected_pages:
+                with os.scandir(self.folder_path) as folder_files:
+                    size = sum(f.stat().st_size for f in folder_files if f.is_file())
+                self._record_download(self.folder_path, 'folder', size)
         else:
-            if status == 2 or (status == 1 and not pages):
+            if status == 2 or (status == 1 and not self.pages):
                 shutil.rmtree(self.folder_path)
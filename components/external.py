@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 import re
+from concurrent.futures import Future
 from datetime import datetime
 
 import requests
@@ -7,6 +8,7 @@ from tqdm import tqdm
 
 from .response_pb2 import Response
 from .model import MDownloader
+from .workers import run_cpu, xor_decrypt
 
 
 
@@ -23,12 +25,14 @@ class ExternalBase:
         exists = self.md_model.exist.check_exist(pages)
         self.md_model.exist.before_download(exists)
 
-        # Decrypt then save each image
+        # Download each image, the decryption runs on the process pool while the next one downloads
+        images = []
         for page in tqdm(pages, desc=(str(datetime.now(tz=None))[:-7])):
             if download_site == 'mangaplus':
-                image = self.decrypt_image(page.image_url, page.encryption_key)
-            page_no = pages.index(page) + 1
-            self.exporter.add_image(image, page_no, self.extension, '')
+                images.append(self.decrypt_image(page.image_url, page.encryption_key))
+
+        for page_no, image in enumerate(images, start=1):
+            self.exporter.add_image(image.result(), page_no, self.extension, '')
 
         downloaded_all = self.md_model.exist.check_exist(pages)
         self.md_model.exist.after_download(downloaded_all)
@@ -59,23 +63,18 @@ class MangaPlus(ExternalBase):
         url = f'https://jumpg-webapi.tokyo-cdn.com/api/manga_viewer?chapter_id={mplus_id}&split=no&img_quality=super_high'
         return url
 
-    def decrypt_image(self, url: str, encryption_hex: str) -> bytearray:
-        """Decrypt the image so it can be saved.
+    def decrypt_image(self, url: str, encryption_hex: str) -> Future:
+        """Download the image and start decrypting it so it can be saved.
 
         Args:
             url (str): The image link.
             encryption_hex (str): The key to decrypt the image.
 
         Returns:
-            bytearray: The image data.
+            Future: The image data.
         """
         resp = requests.get(url)
-        data = bytearray(resp.content)
-        key = bytes.fromhex(encryption_hex)
-        a = len(key)
-        for s in range(len(data)):
-            data[s] ^= key[s % a]
-        return data
+        return run_cpu(xor_decrypt, resp.content, bytes.fromhex(encryption_hex))
 
     def download_mplus_chap(self) -> None:
         """Get the images from the MangaPlus api."""
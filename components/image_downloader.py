@@ -9,7 +9,7 @@ from tqdm import tqdm
 
 from .constants import ImpVar
 from .errors import MDownloaderError
-from .exporter import ArchiveExporter, FolderExporter
+from .exporter import ArchiveExporter, FolderExporter, StreamExporter
 from .model import MDownloader
 
 
@@ -42,10 +42,21 @@ def report_image(
     # data = md_model.api.convertJson(md_mode.chapter_id, 'image-report', response)
 
 
-def get_server(md_model: MDownloader) -> Tuple[Union[str, list]]:
-    """Get the MD@H node to download images from."""
-    server_response = md_model.api.request_data(f'{md_model.mdh_url}/{md_model.chapter_id}')
-    server_data = md_model.api.convert_to_json(md_model.chapter_id, 'chapter-server', server_response)
+def get_server(md_model: MDownloader, force_refresh: bool=False) -> Tuple[Union[str, list]]:
+    """Get the MD@H node to download images from.
+
+    Args:
+        force_refresh (bool, optional): Ask for a new node instead of using the cached one. Defaults to False.
+    """
+    at_home_id = md_model.cache.at_home_key(md_model.chapter_id)
+    cache_json = md_model.cache.load_cache(at_home_id)
+    server_data = cache_json.get('data', {})
+
+    if force_refresh or md_model.cache.check_cache_time(cache_json) or not server_data:
+        server_response = md_model.api.request_data(f'{md_model.mdh_url}/{md_model.chapter_id}')
+        server_data = md_model.api.convert_to_json(md_model.chapter_id, 'chapter-server', server_response)
+        md_model.cache.save_cache(datetime.now(), at_home_id, data=server_data, kind='at-home')
+
     hash = server_data["chapter"]["hash"]
     url = f'{server_data["baseUrl"]}/data/{hash}/'
     return (server_data["chapter"], url, hash, server_data["chapter"]["data"])
@@ -112,7 +123,7 @@ async def image_download(
                         retry = 0
                         fallback_retry = 1
 
-                        _, url, _, pages = get_server(md_model)
+                        _, url, _, pages = get_server(md_model, force_refresh=True)
                         if md_model.debug: print(f'Retrying with the fallback url.')
                     else:
                         print(f'Could not download image {image_link} after {retry} times.')
@@ -146,6 +157,8 @@ def chapter_downloader(md_model: MDownloader) -> None:
     # Make the files
     if md_model.args.folder_download:
         exporter = FolderExporter(md_model)
+    elif md_model.args.stream is not None:
+        exporter = StreamExporter(md_model)
     else:
         exporter = ArchiveExporter(md_model)
 
@@ -155,13 +168,10 @@ def chapter_downloader(md_model: MDownloader) -> None:
         cache_json = md_model.cache.load_cache(chapter_id)
         cache_data = cache_json.get('data', {})
         cache_data.get('attributes', {}).update(page_data)
-        md_model.cache.save_cache(cache_json["cache_date"], download_id=chapter_id, data=cache_data, chapters=cache_json["chapters"], covers=cache_json["covers"])
+        md_model.cache.save_cache(cache_json["cache_date"], download_id=chapter_id, data=cache_data, kind='chapter')
 
     # Add chapter data to the json for title, group or user downloads
-    if md_model.type_id in (1,):
-        md_model.title_json.add_chapter(data)
-    if md_model.type_id in (2, 3):
-        md_model.bulk_json.add_chapter(data)
+    md_model.exist.add_to_json(data)
 
     # External chapters
     external = md_model.misc.check_external(chapter_data)
@@ -1,11 +1,15 @@
 #!/usr/bin/python3
+import asyncio
 import json
 import os
 import re
 from datetime import datetime
+from email.utils import formatdate
 from pathlib import Path
 from urllib.parse import quote
 
+from aiohttp import ClientError, ClientSession
+
 from .constants import ImpVar
 from .errors import MDRequestError
 from .model import MDownloader
@@ -18,7 +22,7 @@ class JsonBase:
         self.type = md_model.download_type
         self.domain = ImpVar.MANGADEX_URL
         self.api_url = ImpVar.MANGADEX_API_URL
-        self.downloaded_ids = []
+        self.downloaded_ids = set()
         self.new_data = {}
 
         if self.md_model.type_id == 1 or self.md_model.manga_download:
@@ -32,24 +36,30 @@ class JsonBase:
 
         self.id = data["id"]
         self.data = data["attributes"]
-        self.route.mkdir(parents=True, exist_ok=True)
+        # Streamed chapters aren't saved, so nothing is recorded in the download folder
+        self.streaming = md_model.args.stream is not None
+        if not self.streaming:
+            self.route.mkdir(parents=True, exist_ok=True)
         self.json_path = self.route.joinpath(f'{file_prefix}{self.id}_data').with_suffix('.json')
+        self.journal_path = self.json_path.with_suffix('.jsonl')
+        self._journal = []
+        self._journal_records = 0
 
         self.data_json = self._check_json_exist()
         self._get_downloaded_chapters()
 
     def _get_downloaded_chapters(self) -> None:
         self.chapters = self.data_json.get('chapters', [])
-        self.json_ids = [c["id"] for c in self.chapters] if self.chapters else []
-        self.chapters_archive = [c["id"] for c in self.chapters if 'chapters_archive' in c and c["chapters_archive"]] if self.chapters else []
-        self.chapters_folder = [c["id"] for c in self.chapters if 'chapters_folder' in c and c["chapters_folder"]] if self.chapters else []
+        self._index_chapters()
+        self._replay_journal()
+        self.json_ids = {c["id"] for c in self.chapters}
+        self.chapters_archive = {c["id"] for c in self.chapters if c.get('chapters_archive')}
+        self.chapters_folder = {c["id"] for c in self.chapters if c.get('chapters_folder')}
 
         if self.md_model.args.folder_download:
-            self.downloaded_ids.extend(self.chapters_folder)
+            self.downloaded_ids.update(self.chapters_folder)
         else:
-            self.downloaded_ids.extend(self.chapters_archive)
-
-        self.downloaded_ids = list(set(self.downloaded_ids))
+            self.downloaded_ids.update(self.chapters_archive)
 
     def _check_json_exist(self) -> dict:
         """Loads the json if it exists."""
@@ -60,10 +70,73 @@ class JsonBase:
         except (FileNotFoundError, json.JSONDecodeError):
             return {}
 
-    def _add_chapter_data(self, chapter_id: str, chapter_data: dict) -> None:
-        """Add the chapter data to the json."""
-        self.chapters.append(chapter_data)
-        self.downloaded_ids.append(chapter_id)
+    @staticmethod
+    def _chapter_key(chapter_data: dict) -> tuple:
+        return chapter_data["id"], chapter_data["attributes"].get("hash")
+
+    def _index_chapters(self) -> None:
+        """Map each chapter's id and hash to its position in the chapters list."""
+        self._positions = {}
+        for position, chapter in enumerate(self.chapters):
+            self._positions.setdefault(self._chapter_key(chapter), position)
+
+    def _put_chapter(self, chapter_data: dict) -> None:
+        """Update the chapter's entry with the same hash, or add the chapter if there isn't one."""
+        key = self._chapter_key(chapter_data)
+        position = self._positions.get(key)
+
+        if position is not None:
+            self.chapters[position].update(chapter_data)
+        else:
+            self._positions[key] = len(self.chapters)
+            self.chapters.append(chapter_data)
+
+    def _drop_chapter(self, chapter_id: str) -> None:
+        """Remove every entry of the chapter."""
+        self.chapters[:] = [c for c in self.chapters if c["id"] != chapter_id]
+        self._index_chapters()
+
+    def _replay_journal(self) -> None:
+        """Apply the chapters saved to the journal since the json was last written.
+
+        Applying a record twice doesn't change the json, so a journal left behind after the json was written is harmless.
+        A record cut off by a crash is removed from the journal.
+        """
+        try:
+            journal_file = open(self.journal_path, 'rb')
+        except FileNotFoundError:
+            return
+
+        with journal_file:
+            end = 0
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    break
+
+                if record["op"] == 'put':
+                    self._put_chapter(record["chapter"])
+                elif record["op"] == 'remove':
+                    self._drop_chapter(record["id"])
+                end += len(line)
+                self._journal_records += 1
+            else:
+                return
+
+        os.truncate(self.journal_path, end)
+
+    def _write_journal(self) -> None:
+        """Append the chapters added since the last save to the journal."""
+        if not self._journal:
+            return
+
+        with open(self.journal_path, 'a', encoding='utf8') as journal_file:
+            journal_file.write(''.join(f'{json.dumps(r, ensure_ascii=False)}\n' for r in self._journal))
+
+        self.md_model.durability.written(self.journal_path)
+        self._journal_records += len(self._journal)
+        self._journal = []
 
     def _add_exporter_type(self, chapter_data_json: dict) -> dict:
         """Add the type of exporter used for the chapter download."""
@@ -79,41 +152,52 @@ class JsonBase:
         chapter_id = chapter_data["id"]
         chapter_data = self._add_exporter_type(chapter_data)
 
-        if chapter_id not in self.downloaded_ids:
-            self._add_chapter_data(chapter_id, chapter_data)
-        else:
-            chapter_data_json = [c for c in self.chapters if c["id"] == chapter_id]
+        # Update the chapter data if it exists
+        self._put_chapter(chapter_data)
+        self._journal.append({"op": "put", "chapter": chapter_data})
 
-            # Update the chapter data if it exists
-            for chapter in chapter_data_json:
-                if chapter["attributes"]["hash"] == chapter_data["attributes"]["hash"]:
-                    self.chapters[self.chapters.index(chapter)] = self._add_exporter_type(chapter)
-                else:
-                    self.add_chapter_data(chapter_id, chapter_data)
+        self.downloaded_ids.add(chapter_id)
 
     def remove_chapter(self, chapter_data: dict) -> None:
         """Remove the chapter data from the data json."""
 
         chapter_id = chapter_data["id"]
-        self.downloaded_ids.remove(chapter_id)
+        self.downloaded_ids.discard(chapter_id)
 
-        chapter_data_json = [c for c in self.chapters if c["id"] == chapter_id]
-        for chapter in chapter_data_json:
-            self.chapters.remove(chapter)
+        self._drop_chapter(chapter_id)
+        self._journal.append({"op": "remove", "id": chapter_id})
 
     def _save_json(self) -> None:
-        """Save the json."""
-        with open(self.json_path, 'w', encoding='utf8') as json_file:
+        """Save the json, the old one is only replaced once the new one is fully written."""
+        durability = self.md_model.durability
+        part_path = Path(f'{self.json_path}.part')
+        with open(part_path, 'w', encoding='utf8') as json_file:
             json.dump(self.new_data, json_file, indent=4, ensure_ascii=False)
 
+        durability.before_rename(part_path)
+        os.replace(part_path, self.json_path)
+        durability.written(self.json_path)
+
     def _core(self, save_type: int=0) -> None:
-        """Format the json for exporting.
+        """Save the new chapters to the journal, the whole json is only written at the end or once the journal gets long.
 
         Args:
             save_type (int, optional): Save the covers after all the manga's chapters have been downloaded. Defaults to 0.
         """
+        if self.streaming:
+            return
+
+        self._write_journal()
+
+        if save_type or self._journal_records >= ImpVar.DATA_JOURNAL_COMPACT:
+            self._compact()
+
+    def _compact(self) -> None:
+        """Write the whole json and remove the journal it now includes."""
         self.new_data["chapters"] = self.chapters
         self._save_json()
+        self.journal_path.unlink(missing_ok=True)
+        self._journal_records = 0
 
 
 
@@ -126,7 +210,7 @@ class TitleJson(JsonBase):
         self.regex = re.compile(ImpVar.CHARA_REGEX)
         self.cover_route = self.route.joinpath('!covers')
         self.links = self._format_links()
-        self.covers = self._get_covers()
+        self._covers = None
         self.title_json = self._title()
 
     def _format_links(self) -> dict:
@@ -170,56 +254,113 @@ class TitleJson(JsonBase):
                 json_links.update({l: {"name": l, "url": newl}})
         return json_links
 
+    @staticmethod
+    def _cover_changed(cover_path: Path, updated_at: str) -> bool:
+        """If the cover was updated on MangaDex after it was saved."""
+        try:
+            return datetime.fromisoformat(updated_at).timestamp() > cover_path.stat().st_mtime
+        except (TypeError, ValueError):
+            return False
+
+    async def _fetch_cover(self, session: ClientSession, semaphore: asyncio.Semaphore, cover_url: str, cover_path: Path) -> None:
+        """Download the cover, covers already saved are only downloaded again if they've changed since."""
+        headers = {}
+        if cover_path.exists():
+            headers["If-Modified-Since"] = formatdate(cover_path.stat().st_mtime, usegmt=True)
+
+        async with semaphore:
+            try:
+                async with session.get(cover_url, headers=headers) as response:
+                    if response.status == 304:
+                        # Unchanged, so the updated date isn't checked against the server again
+                        os.utime(cover_path)
+                        return
+                    if response.status != 200:
+                        print(f'Could not save {cover_path.name}.')
+                        return
+                    cover_data = await response.read()
+            except (ClientError, asyncio.TimeoutError):
+                print(f'Could not save {cover_path.name}.')
+                return
+
+        print(f'Saving cover {cover_path.name}.')
+        part_path = cover_path.with_name(f'{cover_path.name}.part')
+        with open(part_path, 'wb') as file:
+            file.write(cover_data)
+        os.replace(part_path, cover_path)
+        self.md_model.durability.written(cover_path)
+
+    async def _fetch_covers(self, covers: list) -> None:
+        semaphore = asyncio.Semaphore(ImpVar.COVER_WORKERS)
+        async with ClientSession() as session:
+            await asyncio.gather(*(self._fetch_cover(session, semaphore, url, path) for url, path in covers))
+
     def _download_covers(self) -> None:
-        """Download the covers."""
-        json_covers = self.covers
-        covers = json_covers
+        """Download the covers that aren't saved yet or were updated since, at the same time."""
+        covers = self.covers
 
         if covers:
             # Make the covers folder in the manga folder
             self.cover_route.mkdir(parents=True, exist_ok=True)
             print('Downloading covers.')
+            to_download = []
+
             for cover in covers:
                 cover_name = cover["attributes"]["fileName"]
                 cover_volume = cover["attributes"]["volume"]
                 cover_volume = cover_volume if cover_volume is not None else '0'
-                cover_response = self.md_model.api.request_data(f'{self.md_model.cover_cdn_url}/{self.id}/{cover_name}')
-                self.md_model.api.check_response_error(cover_response, 'cover', cover_response)
+                cover_path = self.cover_route.joinpath(f'v{cover_volume.zfill(2)}_{cover_name}')
 
-                if cover_response.status_code != 200:
-                    print(f'Could not save {cover_name}.')
+                if cover_path.exists() and not self._cover_changed(cover_path, cover["attributes"].get("updatedAt")):
                     continue
+                to_download.append((f'{self.md_model.cover_cdn_url}/{self.id}/{cover_name}', cover_path))
 
-                downloaded_cover_name = f'v{cover_volume.zfill(2)}_{cover_name}'
-                cover_response = cover_response.content
-                cover_path = os.path.join(self.cover_route, downloaded_cover_name)
-
-                if not os.path.exists(cover_path):
-                    print(f'Saving cover {downloaded_cover_name}.')
-                    with open(cover_path, 'wb') as file:
-                        file.write(cover_response)
+            if to_download:
+                asyncio.get_event_loop().run_until_complete(self._fetch_covers(to_download))
 
             print('Finished downloadng covers.')
         else:
             print('This title has no covers to download.')
 
-    def _get_covers(self) -> dict:
-        """Fetches a dict of the manga's covers."""
-        cache_json = self.md_model.cache.load_cache(self.id)
+    @property
+    def covers(self) -> list:
+        """The manga's covers, only requested from the api when they're being downloaded."""
+        if self._covers is None:
+            covers = self._get_covers() if self.save_covers else None
+            self._covers = covers if covers is not None else self._known_covers()
+        return self._covers
+
+    def _known_covers(self) -> list:
+        """The covers in the cache, even if it's out of date, or the ones saved in the data json."""
+        cache_json = self.md_model.cache.load_cache(self.md_model.cache.covers_key(self.id))
+        return cache_json.get('covers') or self.data_json.get('covers') or []
+
+    def _get_covers(self) -> list:
+        """Fetches a list of all the manga's covers."""
+        covers_id = self.md_model.cache.covers_key(self.id)
+        cache_json = self.md_model.cache.load_cache(covers_id)
         refresh_cache = self.md_model.cache.check_cache_time(cache_json)
         covers = cache_json.get('covers', [])
 
         if refresh_cache or not covers:
-            cover_response = self.md_model.api.request_data(f'{self.md_model.cover_api_url}', **{"manga[]": self.id, "limit": 100})
+            covers = []
+            offset = 0
 
-            try:
-                data = self.md_model.api.convert_to_json(self.id, 'manga-cover', cover_response)
-            except MDRequestError:
-                print("Couldn't get the covers data.")
-                return
+            while True:
+                cover_response = self.md_model.api.request_data(f'{self.md_model.cover_api_url}', **{"manga[]": self.id, "limit": 100, "offset": offset})
 
-            covers = data.get('data', [])
-            self.md_model.cache.save_cache(cache_json.get("cache_date", datetime.now()), self.id, cache_json.get("data", []), cache_json.get("chapters", []), covers)
+                try:
+                    data = self.md_model.api.convert_to_json(self.id, 'manga-cover', cover_response)
+                except MDRequestError:
+                    print("Couldn't get the covers data.")
+                    return
+
+                covers.extend(data.get('data', []))
+                offset += 100
+                if not data.get('data') or offset >= data.get('total', 0):
+                    break
+
+            self.md_model.cache.save_cache(datetime.now(), covers_id, covers=covers, kind='covers')
 
         return covers
 
@@ -249,13 +390,17 @@ class TitleJson(JsonBase):
         """
         self.new_data = self.title_json
         self.new_data["externalLinks"] = self.links
-        self.new_data["covers"] = self.covers
 
-        if save_type and self.save_covers:
+        if save_type and self.save_covers and not self.streaming:
             self._download_covers()
 
         super()._core(save_type)
 
+    def _compact(self) -> None:
+        """Add the covers to the json before it's written."""
+        self.new_data["covers"] = self.covers
+        super()._compact()
+
 
 
 class BulkJson(JsonBase):
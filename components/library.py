@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+from .cache import SqliteConnection
+
+
+
+class LibraryIndex:
+    """A SQLite index of every chapter downloaded into the download folder.
+
+    Each finished download gets a row with its hash, path, format, page count and size, so any
+    download can check if a chapter is already saved without reading the titles' data jsons.
+
+    Args:
+        db_path (Path): The database file.
+    """
+
+    def __init__(self, db_path: Path) -> None:
+        self.db_path = db_path
+        self._db = SqliteConnection(db_path, self._create_table)
+
+    @staticmethod
+    def _create_table(db: sqlite3.Connection) -> None:
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS downloads ('
+            'chapter_id TEXT NOT NULL, '
+            'format TEXT NOT NULL, '
+            'hash TEXT, '
+            'path TEXT NOT NULL, '
+            'pages INTEGER NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'downloaded_at REAL NOT NULL, '
+            'PRIMARY KEY (chapter_id, format))')
+        db.execute('CREATE INDEX IF NOT EXISTS downloads_path ON downloads (path)')
+
+    def record(self, chapter_id: str, chapter_hash: Optional[str], path: Union[str, Path], download_format: str, pages: int, size: int) -> None:
+        """Save the finished download, replacing the chapter's earlier download in the same format.
+
+        Args:
+            chapter_id (str): The chapter's id.
+            chapter_hash (Optional[str]): The chapter's hash.
+            path (Union[str, Path]): The archive or folder the chapter was saved to.
+            download_format (str): archive or folder.
+            pages (int): The number of pages.
+            size (int): The size of the download in bytes.
+        """
+        self._db.connection().execute(
+            'INSERT OR REPLACE INTO downloads (chapter_id, format, hash, path, pages, size, downloaded_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (chapter_id, download_format, chapter_hash, os.path.abspath(path), pages, size, time.time()))
+
+    def has(self, chapter_id: str, download_format: str, chapter_hash: Optional[str]=None) -> bool:
+        """If the chapter is downloaded in the format, with the same hash if one is given.
+
+        Downloads that were deleted since are removed from the index.
+        """
+        row = self._db.connection().execute(
+            'SELECT hash, path FROM downloads WHERE chapter_id = ? AND format = ?', (chapter_id, download_format)).fetchone()
+        if row is None:
+            return False
+
+        if not os.path.exists(row[1]):
+            self.remove(chapter_id, download_format)
+            return False
+        return chapter_hash is None or row[0] == chapter_hash
+
+    def move(self, old_path: Union[str, Path], new_path: Union[str, Path]) -> None:
+        """Point the downloads saved at the old path to the new one after a rename."""
+        self._db.connection().execute(
+            'UPDATE downloads SET path = ? WHERE path = ?', (os.path.abspath(new_path), os.path.abspath(old_path)))
+
+    def remove(self, chapter_id: str, download_format: str) -> None:
+        self._db.connection().execute('DELETE FROM downloads WHERE chapter_id = ? AND format = ?', (chapter_id, download_format))
+
+    def close(self) -> None:
+        self._db.close()
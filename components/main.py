@@ -63,6 +63,11 @@ def file_downloader(md_model: MDownloader) -> None:
 
     md_model.wait()
 
+    if md_model.args.prefetch:
+        from .prefetch import MetadataPrefetcher
+        MetadataPrefetcher(md_model).prefetch(links)
+        return
+
     print(api_message)
     for download_id in links:
         try:
@@ -89,6 +94,18 @@ def main(vargs: dict) -> None:
         MDownloaderError: Couldn't find the file to download from.
     """
     md_model = MDownloader()
+
+    if vargs["dedup_report"] or vargs["dedup_gc"]:
+        from .dedup import dedup_report, prune_page_store
+        if vargs["dedup_gc"]: prune_page_store(vargs["directory"] or md_model.directory)
+        if vargs["dedup_report"]: dedup_report(vargs["directory"] or md_model.directory)
+        return
+
+    if vargs["cache_gc"] or vargs["cache_stats"]:
+        if vargs["cache_gc"]: md_model.cache.garbage_collect()
+        md_model.cache.report()
+        return
+
     md_model.args.format_args(vargs)
     series_id = md_model.id
 
@@ -115,3 +132,5 @@ def main(vargs: dict) -> None:
     else:
         print(api_message)
         check_type(md_model)
+
+    if md_model.debug: md_model.cache.print_stats()
@@ -1,22 +1,33 @@
+import atexit
 import getpass
-import gzip
+import hashlib
 import html
 import json
-import multiprocessing
 import os
 import re
+import struct
+import threading
 import time
 import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import partial
 from pathlib import Path
-from typing import Optional, Tuple, Union, TYPE_CHECKING
+from typing import Callable, Iterable, Optional, Tuple, Union, TYPE_CHECKING
 
 import requests
 from requests.models import Response
 
+from .archive import ArchiveStream, copy_member
+from .cache import GzipCache, SqliteCache, hydrate_entry, normalise_entry
+from .chapter_index import ChapterIndex, uuid_set, write_chapter_index
 from .constants import ImpVar
+from .durability import DurabilityPolicy
 from .errors import MDownloaderError, MDRequestError, NoChaptersError
 from .languages import get_lang_md
+from .library import LibraryIndex
+from .workers import process_context
 
 if TYPE_CHECKING:
     from .jsonmaker import TitleJson, BulkJson
@@ -51,6 +62,7 @@ class MDownloaderBase:
         self.bulk_json: 'BulkJson' = None
         self.chapter_prefix_dict = {}
         self.exporter: Union['ArchiveExporter', 'FolderExporter'] = None
+        self.library: Optional[LibraryIndex] = None
         self.params = {}
         self.cache_json = {}
         self.chapters_archive = []
@@ -137,17 +149,54 @@ class ApiMD(ModelsBase):
 
         return data
 
-    def get_manga_data(self, download_type: str) -> dict:
+    def get_entity_data(self, download_id: str, download_type: str, url: str, **params: dict) -> dict:
+        """Call the api for a single entity, remembering the ids it says are missing or forbidden.
+
+        Args:
+            download_id (str): The id of the entity.
+            download_type (str): The type of download calling the api.
+            url (str): Request url.
+
+        Raises:
+            MDownloaderError: The id was recently found to be missing or forbidden.
+            MDRequestError: The api returned an error.
+
+        Returns:
+            dict: The entity's data.
+        """
+        self.model.cache.check_missing(download_id, download_type)
+        response = self.request_data(url, **params)
+        try:
+            data = self.convert_to_json(download_id, download_type, response)
+        except MDRequestError as e:
+            if e.status_code in (403, 404):
+                self.model.cache.save_missing(download_id, e.status_code)
+            raise
+
+        if self.model.force_refresh:
+            self.model.cache.clear_missing(download_id)
+        return data
+
+    def get_manga_data(self, download_type: str, manga_id: Optional[str]=None) -> dict:
         """Call the manga api for the data.
 
         Args:
             download_type (str): The type of download calling the manga api.
+            manga_id (Optional[str], optional): The manga to get. Defaults to the model's manga id.
 
         Returns:
             dict: The manga's data.
         """
-        manga_response = self.request_data(f'{self.model.manga_api_url}/{self.model.manga_id}', **{"includes[]": ["artist", "author", "cover"]})
-        return self.convert_to_json(self.model.manga_id, download_type, manga_response)
+        manga_id = manga_id or self.model.manga_id
+        return self.get_entity_data(manga_id, download_type, f'{self.model.manga_api_url}/{manga_id}', **{"includes[]": ["artist", "author", "cover"]})
+
+    def get_chapter_data(self, download_type: str, chapter_id: str) -> dict:
+        """Call the chapter api for the data, including the manga and groups."""
+        return self.get_entity_data(chapter_id, download_type, f'{self.model.chapter_api_url}/{chapter_id}', **{"includes[]": ["manga", "scanlation_group"]})
+
+    def get_group_data(self, download_type: str, group_id: str) -> dict:
+        """Call the group api for the data."""
+        return self.get_entity_data(group_id, download_type, f'{self.model.group_api_url}/{group_id}')
 
 
 
@@ -259,6 +308,8 @@ class ProcessArgs(ModelsBase):
         self.rename_files = bool()
         self.search_manga = False
         self.download_in_order = False
+        self.prefetch = False
+        self.stream: Optional[ArchiveStream] = None
         self.naming_scheme_options = ["default", "original", "number"]
         self.naming_scheme = "default"
 
@@ -271,6 +322,8 @@ class ProcessArgs(ModelsBase):
         self.model.force_refresh = bool(args_dict["refresh"])
         self.model.download_type = str(args_dict["type"])
         self.model.directory = str(args_dict["directory"]) if args_dict["directory"] is not None else self.model.directory
+        if ImpVar.LIBRARY_INDEX:
+            self.model.library = LibraryIndex(Path(self.model.directory).joinpath('.library.db'))
         self.language = get_lang_md(args_dict["language"])
         self.archive_extension = ImpVar.ARCHIVE_EXTENSION
         self._check_archive_extension(self.archive_extension)
@@ -280,11 +333,26 @@ class ProcessArgs(ModelsBase):
         self.range_download = bool(args_dict["range"])
         self.rename_files = bool(args_dict["rename"])
         self.download_in_order = bool(args_dict["order"])
+        self.prefetch = bool(args_dict["prefetch"])
+        self._set_stream(args_dict["stream"], args_dict["stream_meta"])
         if args_dict["login"]: self.model.auth.login()
         if args_dict["search"]:
             self.search_manga = True
             self._find_manga(self.model.id)
 
+    def _set_stream(self, target: Optional[str], meta_path: Optional[str]) -> None:
+        """Stream the archives to stdout or a named pipe instead of saving them.
+
+        Raises:
+            MDownloaderError: Streaming was chosen with folder downloads.
+        """
+        if target is None:
+            return
+        if self.folder_download:
+            raise MDownloaderError("Only archives can be streamed.")
+
+        self.stream = ArchiveStream(target, meta_path)
+
     def _check_archive_extension(self, archive_extension: str) -> str:
         """Check if the file extension is an accepted format. Default: cbz.
 
@@ -330,19 +398,16 @@ class ExistChecker(ModelsBase):
 
     def check_exist(self, pages: list) -> bool:
         """Check if the number of images in the archive or folder match that of the API."""
-        # Only image files are counted
-        if self.model.args.folder_download:
-            files_path = os.listdir(self.model.exporter.folder_path)
-        else:
-            files_path = self.model.exporter.archive.namelist()
+        return self.model.exporter.is_complete(len(pages))
 
-        zip_count = [i for i in files_path if i.endswith(('.png', '.jpg', '.jpeg', '.gif'))]
-
-        if len(pages) == len(zip_count):
-            return True
-        return False
+    def add_to_json(self, chapter_data: dict) -> None:
+        """Add the chapter data to the json for title, group or user downloads."""
+        if self.model.type_id in (1,):
+            self.model.title_json.add_chapter(chapter_data)
+        if self.model.type_id in (2, 3):
+            self.model.bulk_json.add_chapter(chapter_data)
 
-    def _save_json(self) -> None:
+    def save_json(self) -> None:
         """Save the chapter data to the data json and save the json."""
         if self.model.type_id in (1,):
             self.model.title_json.core()
@@ -356,7 +421,7 @@ class ExistChecker(ModelsBase):
         """Skip chapter if its already downloaded."""
         if exists:
             # Add chapter data to the json for title, group or user downloads
-            self._save_json()
+            self.save_json()
             self.model.exporter.close()
             raise MDownloaderError('File already downloaded.')
 
@@ -364,7 +429,7 @@ class ExistChecker(ModelsBase):
         """Save json if all the images were downloaded and close the archive."""
         # If all the images are downloaded, save the json file with the latest downloaded chapter
         if downloaded_all:
-            self._save_json()
+            self.save_json()
 
         # Close the archive
         self.model.exporter.close()
@@ -397,7 +462,7 @@ class DataFormatter(ModelsBase):
 
         processes = []
         for title in available_titles:
-            process = multiprocessing.Process(target=self._title_rename, args=(new_title, title))
+            process = process_context().Process(target=self._title_rename, args=(new_title, title))
             process.start()
             processes.append(process)
 
@@ -420,7 +485,7 @@ class DataFormatter(ModelsBase):
         archive_downloads.reverse()
         folder_downloads.reverse()
 
-        process = multiprocessing.Process(
+        process = process_context().Process(
             target=self._renaming_process,
             args=(new_title, new_title_path, old_title_path, archive_downloads, folder_downloads))
         process.start()
@@ -440,65 +505,92 @@ class DataFormatter(ModelsBase):
         old_cover_route.mkdir(parents=True, exist_ok=True)
         new_cover_route.mkdir(parents=True, exist_ok=True)
 
+        new_covers = set(os.listdir(new_cover_route))
         for cover in os.listdir(old_cover_route):
             old_cover_path = old_title_json.cover_route.joinpath(cover)
-            if cover not in os.listdir(new_cover_route):
+            if cover not in new_covers:
                 new_cover_path = new_title_json.cover_route.joinpath(cover)
                 old_cover_path.rename(new_cover_path)
             else:
                 old_cover_path.unlink()
 
         old_title_json.cover_route.rmdir()
-        old_title_json.json_path.unlink()
+        old_title_json.json_path.unlink(missing_ok=True)
+        old_title_json.journal_path.unlink(missing_ok=True)
         del old_title_json
         del new_title_json
         old_title_path.rmdir()
 
+        # Rename processes skip the exit handlers, save the held back cache entries now
+        self.model.cache.flush()
+
     def _renaming_process(self, new_title, new_title_path, old_title_path, archive_downloads, folder_downloads):
-        pool = multiprocessing.Pool()
+        # The renames only get what they need, the model holds locks and open files that can't be sent to the pool
+        pool = process_context().Pool()
         pool_processes = []
 
         for folder_download in folder_downloads:
-            p = pool.apply(self._folder_rename, args=(new_title, new_title_path, old_title_path, folder_download))
+            p = pool.apply(self._folder_rename, args=(self.file_name_regex, self.model.library, new_title, new_title_path, old_title_path, folder_download))
             pool_processes.append(p)
 
         for archive_download in archive_downloads:
-            p = pool.apply(self._archive_rename, args=(new_title, new_title_path, old_title_path, archive_download))
+            p = pool.apply(self._archive_rename, args=(self.file_name_regex, self.model.library, new_title, new_title_path, old_title_path, archive_download))
             pool_processes.append(p)
 
         pool.close()
         pool.join()
 
-    def _archive_rename(self, new_title: str, new_title_path: 'Path', old_title_path: 'Path', archive_download: str):
+    @staticmethod
+    def _archive_rename(file_name_regex: re.Pattern, library: Optional[LibraryIndex], new_title: str, new_title_path: 'Path', old_title_path: 'Path', archive_download: str):
         """Rename the downloaded archives from the old title into the new title."""
-        old_file_name_match = self.file_name_regex.match(archive_download)
+        old_archive_path = old_title_path.joinpath(archive_download)
+        if archive_download.endswith('.part'):
+            # Unfinished archives are downloaded again under the new title
+            old_archive_path.unlink()
+            return
+
+        old_file_name_match = file_name_regex.match(archive_download)
         if not old_file_name_match:
             return
 
-        old_archive_path = old_title_path.joinpath(archive_download)
-        old_zipfile = zipfile.ZipFile(old_archive_path, mode="r", compression=zipfile.ZIP_DEFLATED)
+        old_zipfile = zipfile.ZipFile(old_archive_path, mode="r")
         old_zipfile_files = old_zipfile.infolist()
 
         old_name = old_file_name_match.group('title')
         file_extension = old_file_name_match.group('extension')
 
         new_archive_path = new_title_path.joinpath(archive_download.replace(old_name, new_title)).with_suffix(f'.{file_extension}')
+
+        if not new_archive_path.exists() and not any(old_name in f.filename for f in old_zipfile_files):
+            # None of the pages are named after the title, the archive can be moved as it is
+            old_zipfile.close()
+            os.replace(old_archive_path, new_archive_path)
+            if library is not None:
+                library.move(old_archive_path, new_archive_path)
+            return
+
         new_zipfile = zipfile.ZipFile(new_archive_path, mode="a", compression=zipfile.ZIP_DEFLATED)
         new_zipfile.comment = old_zipfile.comment
 
+        # Copy the compressed pages across under their new names, nothing is decompressed
+        new_zipfile_files = set(new_zipfile.namelist())
         for old_image_name in old_zipfile_files:
             new_image = old_image_name.filename.replace(old_name, new_title)
-            if new_image not in new_zipfile.namelist():
-                new_zipfile.writestr(new_image, old_zipfile.read(old_image_name))
+            if new_image not in new_zipfile_files:
+                copy_member(old_zipfile, new_zipfile, old_image_name, new_image)
+                new_zipfile_files.add(new_image)
 
         # Close the archives and delete the old file
         old_zipfile.close()
         new_zipfile.close()
         old_archive_path.unlink()
+        if library is not None:
+            library.move(old_archive_path, new_archive_path)
 
-    def _folder_rename(self, new_title: str, new_title_path: 'Path', old_title_path: 'Path', folder_download: str):
+    @staticmethod
+    def _folder_rename(file_name_regex: re.Pattern, library: Optional[LibraryIndex], new_title: str, new_title_path: 'Path', old_title_path: 'Path', folder_download: str):
         """Rename the downloaded folders from the old title into the new title."""
-        old_file_name_match = self.file_name_regex.match(folder_download)
+        old_file_name_match = file_name_regex.match(folder_download)
         if not old_file_name_match:
             return
         old_folder_path = old_title_path.joinpath(folder_download)
@@ -508,18 +600,22 @@ class DataFormatter(ModelsBase):
         new_folder_path = new_title_path.joinpath(new_name)
         new_folder_path.mkdir(parents=True, exist_ok=True)
 
+        new_folder_files = set(os.listdir(new_folder_path))
         for old_image_name in os.listdir(old_folder_path):
             new_image_name = old_image_name.replace(old_name, new_title)
             old_page_path = Path(old_folder_path.joinpath(old_image_name))
-            if new_image_name not in os.listdir(new_folder_path):
+            if new_image_name not in new_folder_files:
                 extension = os.path.splitext(old_page_path)[1]
                 new_page_path = Path(new_folder_path.joinpath(new_image_name)).with_suffix(f'{extension}')
                 old_page_path.rename(new_page_path)
+                new_folder_files.add(new_page_path.name)
             else:
                 old_page_path.unlink()
 
         # Delete old folder after moving
         old_folder_path.rmdir()
+        if library is not None:
+            library.move(old_folder_path, new_folder_path)
 
     def get_title(self, data: dict) -> str:
         """Get the title from the manga data, looks for other languages if English is not available."""
@@ -549,15 +645,16 @@ class DataFormatter(ModelsBase):
 
     def format_title(self, data: dict) -> str:
         """Remove illegal characters from the manga title."""
-        try:
-            os.mkdir(self.model.directory) 
-        except FileExistsError:
-            pass
+        if self.model.args.stream is None:
+            try:
+                os.mkdir(self.model.directory) 
+            except FileExistsError:
+                pass
         title = self.get_title(data)
         title = self.strip_illegal_characters(title)
         self.model.title = title
         self._format_save_route()
-        if self.model.args.rename_files:
+        if self.model.args.rename_files and self.model.args.stream is None:
             self._check_downloaded_files()
         return title
 
@@ -584,65 +681,428 @@ class CacheRead(ModelsBase):
     def __init__(self, model) -> None:
         super().__init__(model)
         self.cache_refresh_time = ImpVar.CACHE_REFRESH_TIME
+        self.refresh_times = {
+            "manga": ImpVar.CACHE_REFRESH_TIME_MANGA,
+            "chapter": ImpVar.CACHE_REFRESH_TIME_CHAPTER,
+            "group": ImpVar.CACHE_REFRESH_TIME_GROUP,
+            "user": ImpVar.CACHE_REFRESH_TIME_USER,
+            "list": ImpVar.CACHE_REFRESH_TIME_LIST,
+            "feed": ImpVar.CACHE_REFRESH_TIME_FEED,
+            "covers": ImpVar.CACHE_REFRESH_TIME_COVERS,
+            # The MD@H server urls stop working after 15 minutes
+            "at-home": min(ImpVar.CACHE_REFRESH_TIME_AT_HOME, 0.25),
+            "missing": ImpVar.CACHE_REFRESH_TIME_MISSING,
+        }
+        # Only useful to the run that asked for them, so they're never saved
+        self.memory_only_kinds = ('at-home',)
         self.root = Path(ImpVar.CACHE_PATH)
         self.root.mkdir(parents=True, exist_ok=True)
         self.force_reset_cache_time = "1970-01-01 00:00:00.000000"
+        self.indent = ImpVar.CACHE_JSON_INDENT if ImpVar.CACHE_JSON_INDENT > 0 else None
+        self.backend = self._get_backend(ImpVar.CACHE_BACKEND)
+        self.memory_size = ImpVar.CACHE_MEMORY_SIZE
+        self._memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        self.write_behind = ImpVar.CACHE_WRITE_BEHIND
+        self.write_behind_limit = 500
+        self._pending = {}
+        self._digests = {}
+
+        self.max_size = ImpVar.CACHE_MAX_SIZE * 1024 * 1024
+        self.max_age = ImpVar.CACHE_MAX_AGE
+        self.stats_path = self.root.joinpath('cache_stats.json')
+
+        self.stale_while_revalidate = ImpVar.CACHE_STALE_WHILE_REVALIDATE
+        self.max_staleness = ImpVar.CACHE_MAX_STALENESS
+        self._revalidate_worker = None
+        self._revalidating = set()
+        self._lock = threading.RLock()
+
+        self.index_threshold = ImpVar.CACHE_CHAPTER_INDEX_THRESHOLD
+        self.index_root = self.root.joinpath('index')
+        self._indexes = {}
+        atexit.register(self._close)
+
+    def __getstate__(self) -> dict:
+        # Rename processes get a copy of the model, leave out the locks, threads, maps and unsaved entries
+        state = self.__dict__.copy()
+        state.update({"_lock": None, "_revalidate_worker": None, "_revalidating": set(), "_indexes": {}, "_pending": {}, "_memory": OrderedDict()})
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def _close(self) -> None:
+        """Save the held back entries and the hit counters, then keep the cache under its size limit."""
+        self.wait_for_revalidation()
+        self.flush()
+        self._save_stats()
+        if self.max_size:
+            self.garbage_collect(quiet=True)
+
+    def _get_backend(self, cache_backend: str) -> Union[GzipCache, SqliteCache]:
+        """Pick where the cache entries are stored. Default: gzip.
+
+        Raises:
+            MDownloaderError: The backend chosen isn't available.
+        """
+        if cache_backend == 'gzip':
+            return GzipCache(self.root, self.indent, ImpVar.CACHE_COMPRESSION_LEVEL)
+        elif cache_backend == 'sqlite':
+            return SqliteCache(self.root, self._expiry_time, self.indent)
+        raise MDownloaderError("This cache backend is not allowed.")
+
+    def _expiry_time(self, cache_json: dict) -> datetime:
+        """The time the cache entry needs to be refreshed by, depending on the kind of entry."""
+        cache_time = cache_json.get("cache_date", self.force_reset_cache_time)
+        try:
+            cache_time = datetime.strptime(cache_time, "%Y-%m-%d %H:%M:%S.%f")
+        except ValueError:
+            cache_time = datetime.strptime(self.force_reset_cache_time, "%Y-%m-%d %H:%M:%S.%f")
 
-    def save_cache(self, cache_time: Union[str, datetime], download_id: str, data: dict={}, chapters: list=[], covers: list=[]) -> None:
+        refresh_time = self.refresh_times.get(cache_json.get('kind'), self.cache_refresh_time)
+        return cache_time + timedelta(hours=refresh_time)
+
+    def _digest(self, cache_json: dict) -> str:
+        """Hash the cached content, ignoring when it was cached."""
+        content = {k: v for k, v in cache_json.items() if k != 'cache_date'}
+        return hashlib.blake2b(json.dumps(content, sort_keys=True, ensure_ascii=False).encode('utf-8'), digest_size=16).hexdigest()
+
+    def feed_key(self, download_id: str, params: dict) -> str:
+        """The id the chapter list of a manga, group, user, list or follows is cached under.
+
+        Each language gets its own entry, the other feed parameters are hashed into the id
+        so feeds requested differently don't overwrite each other.
+
+        Args:
+            download_id (str): The id of the manga, group, user, list or follows.
+            params (dict): The parameters the feed is requested with.
+
+        Returns:
+            str: The cache id of the feed.
+        """
+        language = params.get('translatedLanguage[]', '')
+        if isinstance(language, (list, tuple)):
+            language = '+'.join(sorted(language))
+
+        ignored = ('translatedLanguage[]', 'limit', 'offset', 'createdAtSince')
+        key_params = {k: v for k, v in params.items() if k not in ignored}
+        digest = hashlib.blake2b(json.dumps(key_params, sort_keys=True).encode('utf-8'), digest_size=4).hexdigest()
+        return f'{download_id}-feed-{language or "all"}-{digest}'
+
+    def covers_key(self, manga_id: str) -> str:
+        """The id the manga's cover list is cached under."""
+        return f'{manga_id}-covers'
+
+    def at_home_key(self, chapter_id: str) -> str:
+        """The id the chapter's MD@H server is cached under."""
+        return f'{chapter_id}-at-home'
+
+    def missing_key(self, download_id: str) -> str:
+        """The id an api 403 or 404 for the entity is cached under."""
+        return f'{download_id}-missing'
+
+    def save_missing(self, download_id: str, status_code: int) -> None:
+        """Remember the entity is missing or forbidden, so it's skipped until the entry expires."""
+        self.save_cache(datetime.now(), self.missing_key(download_id), data={"status": status_code}, kind='missing')
+
+    def clear_missing(self, download_id: str) -> None:
+        """Forget the entity was missing, after the api returned it again."""
+        missing_id = self.missing_key(download_id)
+        with self._lock:
+            self._forget([missing_id])
+            self.backend.delete(missing_id)
+
+    def check_missing(self, download_id: str, download_type: str) -> None:
+        """Skip the entity if the api recently returned a 403 or 404 for it.
+
+        Args:
+            download_id (str): The id of the entity.
+            download_type (str): The type of download.
+
+        Raises:
+            MDownloaderError: The entity was found to be missing or forbidden and the entry hasn't expired.
+        """
+        if self.model.force_refresh:
+            return
+
+        cache_json = self.load_cache(self.missing_key(download_id))
+        if not cache_json.get('data') or datetime.now() >= self._expiry_time(cache_json):
+            return
+        raise MDownloaderError(f'{download_id}: {download_type}. Error: {cache_json["data"]["status"]}. Detail: Skipped, the api returned this error at {cache_json["cache_date"][:-7]}. Use --refresh to try again.')
+
+    def save_cache(self, cache_time: Union[str, datetime], download_id: str, data: dict={}, chapters: list=[], covers: list=[], kind: str='') -> None:
         """Save the data to the cache.
 
+        Entries whose content hasn't changed since they were last loaded or saved only get
+        their cache date moved forward. With write-behind on, the entry is held in memory
+        until the next flush. Memory-only kinds are never written to the backend.
+
         Args:
             cache_time (str): The time the cache was saved.
             download_id (str): The id of the data to cache.
             data (dict, optional): The data to cache. Defaults to {}.
             chapters (list, optional): The chapters to cache. Defaults to [].
             covers (list, optional): The covers of the manga.. Defaults to [].
+            kind (str, optional): What the entry holds, picks how long it's kept for. Defaults to ''.
         """
         if cache_time == '':
             cache_time = self.force_reset_cache_time
 
-        cache_json = {"cache_date": str(cache_time), "data": data, "covers": covers, "chapters": chapters}
-        cache_file_path = self.root.joinpath(f'{download_id}').with_suffix('.json.gz')
-        if self.model.debug: print(cache_file_path)
+        cache_json = {"cache_date": str(cache_time), "kind": kind, "data": data, "covers": covers, "chapters": chapters}
+
+        if kind in self.memory_only_kinds:
+            with self._lock:
+                self._remember(download_id, cache_json)
+            return
+
+        digest = self._digest(cache_json)
+
+        with self._lock:
+            if self._digests.get(download_id) == digest:
+                if self.model.debug: print(f'Cache unchanged: {download_id}')
+                self._remember(download_id, cache_json)
+                if download_id in self._pending:
+                    self._pending[download_id] = cache_json
+                else:
+                    self.backend.touch(download_id, cache_json)
+                return
+
+            self._digests[download_id] = digest
+            self._remember(download_id, cache_json)
+
+            if self.write_behind:
+                self._pending[download_id] = cache_json
+                if len(self._pending) >= self.write_behind_limit:
+                    self.flush()
+            else:
+                if self.model.debug: print(f'Saving cache: {download_id}')
+                self.backend.write(download_id, self._stored_entry(download_id, cache_json))
+
+    def flush(self) -> None:
+        """Write the entries held back by write-behind to the backend."""
+        with self._lock:
+            if not self._pending:
+                return
+
+            pending = self._pending
+            self._pending = {}
+            if self.model.debug: print(f'Saving {len(pending)} cache entries.')
+            self.backend.write_many({download_id: self._stored_entry(download_id, cache_json) for download_id, cache_json in pending.items()})
+
+    def _remember(self, download_id: str, cache_json: dict) -> None:
+        """Keep the entry in memory, dropping the least recently used entries past the size limit."""
+        if self.memory_size <= 0:
+            return
+
+        self._memory[download_id] = cache_json
+        self._memory.move_to_end(download_id)
 
-        with gzip.open(cache_file_path, 'w') as cache_json_fp:
-            cache_json_fp.write(json.dumps(cache_json, indent=4, ensure_ascii=False).encode('utf-8'))
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
 
-    def load_cache(self, download_id: str) -> dict:
+    def _index_path(self, download_id: str) -> Path:
+        return self.index_root.joinpath(f'{download_id}.idx')
+
+    def _stored_entry(self, download_id: str, cache_json: dict) -> dict:
+        """The form of the entry given to the backend.
+
+        Chapter lists past the index threshold are saved to a chapter index instead of the entry.
+        """
+        chapters = cache_json.get('chapters', [])
+        index_path = self._index_path(download_id)
+        self._close_index(download_id)
+
+        try:
+            if self.index_threshold and len(chapters) >= self.index_threshold:
+                write_chapter_index(index_path, chapters)
+                cache_json = {**cache_json, "chapters": [], "chapter_index": len(chapters)}
+            else:
+                index_path.unlink(missing_ok=True)
+        except OSError as e:
+            # Another process has the index open, keep the chapters in the entry
+            if self.model.debug: print(f"Couldn't update the chapter index of {download_id}: {e}")
+        return normalise_entry(cache_json)
+
+    def chapter_index(self, download_id: str) -> Optional[ChapterIndex]:
+        """Open the entry's chapter index, None if it doesn't have one."""
+        with self._lock:
+            if download_id not in self._indexes:
+                try:
+                    self._indexes[download_id] = ChapterIndex(self._index_path(download_id))
+                except (OSError, ValueError, struct.error):
+                    return None
+            return self._indexes[download_id]
+
+    def _close_index(self, download_id: str) -> None:
+        chapter_index = self._indexes.pop(download_id, None)
+        if chapter_index is not None:
+            chapter_index.close()
+
+    def _materialise(self, download_id: str, cache_json: dict) -> dict:
+        """Fill in the chapters of an entry saved with a chapter index."""
+        chapter_index = self.chapter_index(download_id)
+        cache_json = {k: v for k, v in cache_json.items() if k != 'chapter_index'}
+        cache_json["chapters"] = chapter_index.chapters() if chapter_index is not None else []
+        self._digests[download_id] = self._digest(cache_json)
+        return cache_json
+
+    def load_cache(self, download_id: str, materialise: bool=True) -> dict:
         """Load the cache data.
 
         Args:
             download_id (str): The id of the cache data to load.
+            materialise (bool, optional): Read the chapters back from the chapter index if the entry has one,
+                otherwise the chapters are left empty and the index can be used with chapter_index. Defaults to True.
 
         Returns:
             dict: The cache's data.
         """
-        cache_file_path = self.root.joinpath(f'{download_id}').with_suffix('.json.gz')
-        if self.model.debug: print(cache_file_path)
+        with self._lock:
+            if download_id in self._memory:
+                self.hits += 1
+                self._memory.move_to_end(download_id)
+                cache_json = self._memory[download_id]
+            elif download_id in self._pending:
+                self.hits += 1
+                return dict(self._pending[download_id])
+            else:
+                self.misses += 1
+                if self.model.debug: print(f'Loading cache: {download_id}')
+                cache_json = hydrate_entry(self.backend.read(download_id))
+                if cache_json:
+                    self._digests[download_id] = self._digest(cache_json)
+
+            if materialise and 'chapter_index' in cache_json:
+                cache_json = self._materialise(download_id, cache_json)
+            self._remember(download_id, cache_json)
+            return dict(cache_json)
+
+    def print_stats(self) -> None:
+        """Print how many cache reads were served from memory."""
+        total = self.hits + self.misses
+        ratio = (self.hits / total * 100) if total else 0
+        print(f'Cache reads: {total}, memory hits: {self.hits}, misses: {self.misses} ({ratio:.1f}% hit ratio).')
+
+    def _load_stats(self) -> dict:
+        try:
+            with open(self.stats_path, 'r') as stats_file:
+                return json.load(stats_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"hits": 0, "misses": 0}
+
+    def _save_stats(self) -> None:
+        """Add this run's hits and misses to the saved totals."""
+        if not self.hits and not self.misses:
+            return
 
+        stats = self._load_stats()
+        stats["hits"] = stats.get('hits', 0) + self.hits
+        stats["misses"] = stats.get('misses', 0) + self.misses
+        self.hits = self.misses = 0
+
+        with open(self.stats_path, 'w') as stats_file:
+            json.dump(stats, stats_file)
+
+    def _forget(self, download_ids: list) -> None:
+        """Drop the in-memory copies and chapter indexes of deleted entries."""
+        for download_id in download_ids:
+            self._close_index(download_id)
+            self._index_path(download_id).unlink(missing_ok=True)
+            self._memory.pop(download_id, None)
+            self._pending.pop(download_id, None)
+            self._digests.pop(download_id, None)
+
+    def _index_sizes(self) -> dict:
+        """The size of each entry's chapter index file."""
         try:
-            with gzip.open(cache_file_path, 'r') as cache_json_fp:
-                cache_json = json.loads(cache_json_fp.read().decode('utf-8'))
-            return cache_json
-        except (FileNotFoundError, json.JSONDecodeError, gzip.BadGzipFile):
+            with os.scandir(self.index_root) as index_files:
+                return {f.name[:-len('.idx')]: f.stat().st_size for f in index_files if f.name.endswith('.idx') and f.is_file()}
+        except FileNotFoundError:
             return {}
 
-    def check_cache_time(self, cache_json: dict) -> bool:
+    def _entries(self) -> list:
+        """The stored entries, with the chapter index moved out of each entry counted in its size."""
+        index_sizes = self._index_sizes()
+        return [e._replace(size=e.size + index_sizes.get(e.download_id, 0)) for e in self.backend.entries()]
+
+    def garbage_collect(self, quiet: bool=False) -> Tuple[int, int]:
+        """Delete entries older than the max age, then the least recently used until under the size limit.
+
+        Args:
+            quiet (bool, optional): Don't print what was deleted. Defaults to False.
+
+        Returns:
+            Tuple[int, int]: The number of entries deleted and their size in bytes.
+        """
+        self.flush()
+        now = time.time()
+        entries = self._entries()
+        to_delete = []
+
+        if self.max_age:
+            to_delete = [e for e in entries if now - e.cached_at > self.max_age * 3600]
+            entries = [e for e in entries if now - e.cached_at <= self.max_age * 3600]
+
+        if self.max_size:
+            total_size = 0
+            for entry in sorted(entries, key=lambda e: e.last_access, reverse=True):
+                total_size += entry.size
+                if total_size > self.max_size:
+                    to_delete.append(entry)
+
+        deleted_ids = [e.download_id for e in to_delete]
+        freed = sum(e.size for e in to_delete)
+        if deleted_ids:
+            self.backend.delete_many(deleted_ids)
+            self._forget(deleted_ids)
+            # Rebuilding the database is slow, the exit cleanup leaves the freed space for new entries
+            if not quiet:
+                self.backend.compact()
+
+        if not quiet or self.model.debug:
+            print(f'Removed {len(deleted_ids)} cache entries, freeing {freed / 1024 / 1024:.2f} MB.')
+        return len(deleted_ids), freed
+
+    def report(self) -> None:
+        """Print the number of entries, their size and the hit ratio of every run so far."""
+        self.flush()
+        self._save_stats()
+        entries = self._entries()
+        stats = self._load_stats()
+        total = stats.get('hits', 0) + stats.get('misses', 0)
+        ratio = (stats.get('hits', 0) / total * 100) if total else 0
+
+        print(f'Cache folder: {self.root.resolve()} ({ImpVar.CACHE_BACKEND})')
+        print(f'Entries: {len(entries)}')
+        print(f'Entry size: {sum(e.size for e in entries) / 1024 / 1024:.2f} MB, on disk: {(self.backend.disk_size() + sum(self._index_sizes().values())) / 1024 / 1024:.2f} MB')
+        print(f'Reads: {total}, hits: {stats.get("hits", 0)}, misses: {stats.get("misses", 0)} ({ratio:.1f}% hit ratio)')
+
+    def check_cache_time(self, cache_json: dict, download_id: str='', fetch: Optional[Callable[[], dict]]=None) -> bool:
         """Check if the cache needs to be refreshed.
 
+        With stale-while-revalidate on, expired entries within the max staleness are still used
+        and the fetch function is called in the background to refresh them.
+
         Args:
             cache_json (dict): The cache data.
+            download_id (str, optional): The id of the cache data. Defaults to ''.
+            fetch (Optional[Callable[[], dict]], optional): Gets the new data to cache. Defaults to None.
 
         Returns:
             bool: If a refresh is needed.
         """
         refresh = True
         if cache_json:
-            cache_time = cache_json.get("cache_date", self.force_reset_cache_time)
-            timestamp = datetime.strptime(cache_time, "%Y-%m-%d %H:%M:%S.%f") + timedelta(hours=self.cache_refresh_time)
-            if datetime.now() >= timestamp:
-                pass
-            else:
+            expiry_time = self._expiry_time(cache_json)
+            if datetime.now() < expiry_time:
+                refresh = False
+            elif self.stale_while_revalidate and fetch is not None and \
+                    datetime.now() < expiry_time + timedelta(hours=self.max_staleness):
+                self._revalidate(download_id, fetch, cache_json.get('kind', ''))
                 refresh = False
 
         if self.model.force_refresh:
@@ -654,6 +1114,37 @@ class CacheRead(ModelsBase):
             if self.model.debug: print('Using cache data.')
         return refresh
 
+    def _revalidate(self, download_id: str, fetch: Callable[[], dict], kind: str) -> None:
+        """Refresh the entry on the background worker, once per id."""
+        with self._lock:
+            if download_id in self._revalidating:
+                return
+            self._revalidating.add(download_id)
+
+            if self._revalidate_worker is None:
+                self._revalidate_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache-revalidate')
+
+        if self.model.debug: print(f'Refreshing cache in the background: {download_id}')
+        self._revalidate_worker.submit(self._revalidate_entry, download_id, fetch, kind)
+
+    def _revalidate_entry(self, download_id: str, fetch: Callable[[], dict], kind: str) -> None:
+        try:
+            data = fetch()
+            self.save_cache(datetime.now(), download_id, data=data, kind=kind)
+        except Exception as e:
+            if self.model.debug: print(f"Couldn't refresh the cache for {download_id}: {e}")
+        finally:
+            with self._lock:
+                self._revalidating.discard(download_id)
+            # Space out the background requests like the main thread does
+            self.model.wait()
+
+    def wait_for_revalidation(self) -> None:
+        """Finish the background refreshes."""
+        if self._revalidate_worker is not None:
+            self._revalidate_worker.shutdown(wait=True)
+            self._revalidate_worker = None
+
 
 
 class Filtering(ModelsBase):
@@ -693,6 +1184,29 @@ class Filtering(ModelsBase):
                     or [u for u in c["relationships"] if u["type"] == 'user' and u["id"] not in self.user_blacklist])]
         return chapters
 
+    def filter_index(self, chapter_index: ChapterIndex) -> list:
+        """Filters the rows of a chapter index the same way as filter_chapters, without building the chapters.
+
+        Returns:
+            list: The rows to download.
+        """
+        rows = range(len(chapter_index))
+
+        if self.group_whitelist or self.user_whitelist:
+            if self.group_whitelist:
+                group_whitelist = uuid_set(self.group_whitelist)
+                rows = [r for r in rows if any(g in group_whitelist for g in chapter_index.group_ids(r))]
+            if self.user_whitelist:
+                user_whitelist = uuid_set(self.user_whitelist)
+                rows = [r for r in rows if any(u in user_whitelist for u in chapter_index.user_ids(r))]
+        else:
+            group_blacklist = uuid_set(self.group_blacklist)
+            user_blacklist = uuid_set(self.user_blacklist)
+            rows = [r for r in rows if
+                (any(g not in group_blacklist for g in chapter_index.group_ids(r))
+                    or any(u not in user_blacklist for u in chapter_index.user_ids(r)))]
+        return list(rows)
+
 
 
 class MDownloaderMisc(ModelsBase):
@@ -769,16 +1283,16 @@ class MDownloaderMisc(ModelsBase):
 
         if not manga_data:
             cache_json = self.model.cache.load_cache(manga_id)
-            refresh_cache = self.model.cache.check_cache_time(cache_json)
+            refresh_cache = self.model.cache.check_cache_time(cache_json, manga_id, partial(self.model.api.get_manga_data, 'chapter-manga', manga_id))
             manga_data = cache_json.get('data', {})
 
             if refresh_cache or not manga_data:
                 if self.model.debug: print('Calling api for manga data from chapter download.')
-                manga_data = self.model.api.get_manga_data('chapter-manga')
-                self.model.cache.save_cache(datetime.now(), manga_id, data=manga_data)
+                manga_data = self.model.api.get_manga_data('chapter-manga', manga_id)
+                self.model.cache.save_cache(datetime.now(), manga_id, data=manga_data, kind='manga')
         else:
             manga_data = manga
-            self.model.cache.save_cache(datetime.now(), manga_id, data=manga_data)
+            self.model.cache.save_cache(datetime.now(), manga_id, data=manga_data, kind='manga')
 
         return manga_data
 
@@ -816,17 +1330,22 @@ class TitleDownloaderMisc(ModelsBase):
         Returns:
             dict: A map of the volume number to prefix.
         """
+        return self._volume_prefixes((c["attributes"]["volume"], c["attributes"]["chapter"]) for c in chapters)
+
+    def get_index_prefixes(self, chapter_index: ChapterIndex) -> dict:
+        """Assign each volume of a chapter index a prefix, the same way as get_prefixes."""
+        return self._volume_prefixes((chapter_index.volume(r), chapter_index.chapter_number(r)) for r in range(len(chapter_index)))
+
+    def _volume_prefixes(self, volume_chapters: Iterable[Tuple[Optional[str], Optional[str]]]) -> dict:
         volume_dict = {}
         chapter_prefix_dict = {}
 
         # Loop over the chapters and add the chapter numbers to the volume number dict
-        for c in chapters:
-            c = c["attributes"]
-            volume_no = c["volume"]
+        for volume_no, chapter_no in volume_chapters:
             try:
-                volume_dict[volume_no].append(c["chapter"])
+                volume_dict[volume_no].append(chapter_no)
             except KeyError:
-                volume_dict[volume_no] = [c["chapter"]]
+                volume_dict[volume_no] = [chapter_no]
 
         list_volume_dict = list(reversed(list(volume_dict)))
         prefix = 'b'
@@ -911,14 +1430,31 @@ class TitleDownloaderMisc(ModelsBase):
         Returns:
             list: The chapters to download.
         """
-        chapters_list = [c["attributes"]["chapter"] for c in chapters]
-        chapters_list = list(set(chapters_list))
+        chapters_to_download = self._chosen_chapter_numbers([c["attributes"]["chapter"] for c in chapters])
+        if chapters_to_download is None:
+            return chapters
+        return [c for c in chapters if c["attributes"]["chapter"] in chapters_to_download]
+
+    def download_range_index(self, chapter_index: ChapterIndex, rows: list) -> list:
+        """Get the rows of the chapter numbers you want to download, without building the chapters.
+
+        Returns:
+            list: The rows to download.
+        """
+        chapters_to_download = self._chosen_chapter_numbers([chapter_index.chapter_number(r) for r in rows])
+        if chapters_to_download is None:
+            return rows
+        return [r for r in rows if chapter_index.chapter_number(r) in chapters_to_download]
+
+    def _chosen_chapter_numbers(self, chapter_numbers: list) -> Optional[set]:
+        """Ask which of the chapter numbers to download, None if there aren't any to choose from."""
+        chapters_list = list(set(chapter_numbers))
         chapters_list.sort(key=self._natsort)
         chapters_list_str = ['oneshot' if c is None else c for c in chapters_list]
         remove_chapters = []
 
         if not chapters_list:
-            return chapters
+            return None
 
         print(f'Available chapters:\n{", ".join(chapters_list_str)}')
         chap_list = input("\nEnter the chapter(s) to download: ").strip()
@@ -941,8 +1477,8 @@ class TitleDownloaderMisc(ModelsBase):
 
         for i in remove_chapters:
             chapters_to_download.remove(i)
-        
-        return [c for c in chapters if c["attributes"]["chapter"] in chapters_to_download] 
+
+        return set(chapters_to_download)
 
 
 
@@ -960,6 +1496,9 @@ class MDownloader(MDownloaderBase):
         self.filter = Filtering(self)
         self.misc = MDownloaderMisc(self)
         self.title_misc = TitleDownloaderMisc(self)
+        self.durability = DurabilityPolicy(ImpVar.DURABILITY, ImpVar.DURABILITY_BATCH)
+        # Flush whatever is left of the last batch
+        atexit.register(self.durability.sync)
 
     def wait(self, time_to_wait: int=ImpVar.GLOBAL_TIME_TO_WAIT, print_message: bool=False) -> None:
         """Wait a certain amount of time before continuing.
@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+from .constants import ImpVar
+from .downloader import entity_request
+from .errors import MDownloaderError, MDRequestError
+from .model import MDownloader
+
+
+
+class RateLimiter:
+    """Spaces out requests shared between threads so no more than the rate are sent per second."""
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            sleep_for = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+
+        if sleep_for > 0:
+            time.sleep(sleep_for)
+
+
+
+class MetadataPrefetcher:
+    """Fill the cache with the metadata of every id in a batch file without downloading any images.
+
+    Args:
+        md_model (MDownloader): The base class this program runs on.
+    """
+
+    def __init__(self, md_model: MDownloader) -> None:
+        self.md_model = md_model
+        self.cache = md_model.cache
+        self.language = md_model.args.language
+        self.content_rating = ["safe", "suggestive", "erotica", "pornographic"]
+        self.rate_limiter = RateLimiter(ImpVar.PREFETCH_RATE_LIMIT)
+        self.workers = ImpVar.PREFETCH_WORKERS
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._seen = set()
+        self.manga_ids = {}
+        self.group_ids = set()
+        self.requests_made = 0
+
+    def _session(self) -> requests.Session:
+        """Each worker thread gets its own session with the logged in headers."""
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+            self._local.session.headers.update(self.md_model.api.session.headers)
+        return self._local.session
+
+    def _get(self, download_id: str, download_type: str, url: str, negative_cache: bool=True, **params) -> dict:
+        """Request the url, entity requests skip and remember the ids the api says are missing.
+
+        Feed and cover pages are requested with negative_cache off, they belong to the entity
+        so their errors shouldn't mark it as missing.
+        """
+        if negative_cache:
+            self.cache.check_missing(download_id, download_type)
+        self.rate_limiter.wait()
+        response = self._session().get(url, params=params)
+        if self.md_model.debug: print(response.url)
+
+        with self._lock:
+            self.requests_made += 1
+
+        try:
+            return self.md_model.api.convert_to_json(download_id, download_type, response)
+        except MDRequestError as e:
+            if negative_cache and e.status_code in (403, 404):
+                self.cache.save_missing(download_id, e.status_code)
+            raise
+
+    def _claim(self, key: str) -> bool:
+        """Make sure each entity is only fetched once."""
+        with self._lock:
+            if key in self._seen:
+                return False
+            self._seen.add(key)
+            return True
+
+    def _is_fresh(self, download_id: str, needs: tuple=('data',)) -> bool:
+        cache_json = self.cache.load_cache(download_id)
+        if not all(cache_json.get(n) for n in needs):
+            return False
+        return not self.cache.check_cache_time(cache_json)
+
+    def _get_feed(self, download_id: str, download_type: str, url: str, params: dict, limit: int) -> list:
+        """Go through every page of a chapter feed, the same way get_chapters does."""
+        chapters = []
+        offset = 0
+        created_at_since_time = '2000-01-01T00:00:00'
+
+        while True:
+            params.update({"limit": limit, "offset": offset, "createdAtSince": created_at_since_time})
+            data = self._get(download_id, f'{download_type}-chapters', url, negative_cache=False, **params)
+            chapters.extend(data["data"])
+            offset += limit
+            total = data.get('total', 0)
+
+            if not data["data"] or offset >= total:
+                break
+
+            # Offset 10000 is the highest the api goes, carry on from the last chapter's created at date
+            if offset >= 10000:
+                created_at_since_time = chapters[-1]["attributes"]["createdAt"].split('+')[0]
+                offset = 0
+        return chapters
+
+    def _add_relationships(self, chapters: list) -> None:
+        """Queue the manga and groups the chapters belong to."""
+        with self._lock:
+            for chapter in chapters:
+                for relationship in chapter["relationships"]:
+                    if relationship["type"] == 'manga':
+                        self.manga_ids.setdefault(relationship["id"], False)
+                    elif relationship["type"] == 'scanlation_group' and 'attributes' not in relationship:
+                        self.group_ids.add(relationship["id"])
+
+    def _prefetch_chapter(self, chapter_id: str) -> None:
+        if self._is_fresh(chapter_id):
+            chapter_data = self.cache.load_cache(chapter_id)["data"]
+        else:
+            chapter_data = self._get(chapter_id, 'chapter', f'{self.md_model.chapter_api_url}/{chapter_id}', **{"includes[]": ["manga", "scanlation_group"]})
+            self.cache.save_cache(datetime.now(), chapter_id, data=chapter_data, kind='chapter')
+        self._add_relationships([chapter_data])
+
+    def _prefetch_bulk(self, download_id: str, download_type: str) -> None:
+        """Cache a group, user or list and its chapters."""
+        # The same parameters bulk_download requests the feed with, so it finds the cached feed
+        params = {"translatedLanguage[]": self.language, "contentRating[]": self.content_rating, "order[createdAt]": "desc", "includes[]": ["manga"]}
+        limit = 100
+
+        if download_type == 'list':
+            feed_url = f'{self.md_model.list_api_url}/{download_id}/feed'
+            limit = 500
+        else:
+            feed_url = self.md_model.chapter_api_url
+            if download_type == 'group':
+                params["groups[]"] = download_id
+            else:
+                params["uploader"] = download_id
+
+        feed_id = self.cache.feed_key(download_id, params)
+        if self._is_fresh(download_id) and self._is_fresh(feed_id, ('chapters',)):
+            self._add_relationships(self.cache.load_cache(feed_id)["chapters"])
+            return
+
+        entity_url, entity_params = entity_request(self.md_model, download_type, download_id)
+        data = self._get(download_id, download_type, entity_url, **entity_params)
+
+        chapters = self._get_feed(download_id, download_type, feed_url, params, limit)
+        self.cache.save_cache(datetime.now(), download_id, data=data, kind=download_type)
+        self.cache.save_cache(datetime.now(), feed_id, chapters=chapters, kind='feed')
+        self._add_relationships(chapters)
+
+    def _prefetch_manga(self, manga_id: str, with_feed: bool) -> None:
+        """Cache the manga's data, covers and if needed its chapters.
+
+        Each part is cached separately, so only the ones past their refresh time are fetched.
+        """
+        if not self._is_fresh(manga_id):
+            manga_data = self._get(manga_id, 'manga', f'{self.md_model.manga_api_url}/{manga_id}', **{"includes[]": ["artist", "author", "cover"]})
+            self.cache.save_cache(datetime.now(), manga_id, data=manga_data, kind='manga')
+
+        covers_id = self.cache.covers_key(manga_id)
+        if not self._is_fresh(covers_id, ('covers',)):
+            covers = []
+            offset = 0
+            while True:
+                covers_data = self._get(manga_id, 'manga-cover', self.md_model.cover_api_url, negative_cache=False, **{"manga[]": manga_id, "limit": 100, "offset": offset})
+                covers.extend(covers_data["data"])
+                offset += 100
+                if not covers_data["data"] or offset >= covers_data.get('total', 0):
+                    break
+            self.cache.save_cache(datetime.now(), covers_id, covers=covers, kind='covers')
+
+        params = {"translatedLanguage[]": self.language, "contentRating[]": self.content_rating, "order[chapter]": "desc", "order[volume]": "desc"}
+        feed_id = self.cache.feed_key(manga_id, params)
+        if with_feed and not self._is_fresh(feed_id, ('chapters',)):
+            chapters = self._get_feed(manga_id, 'manga', f'{self.md_model.manga_api_url}/{manga_id}/feed', params, 500)
+            self.cache.save_cache(datetime.now(), feed_id, chapters=chapters, kind='feed')
+
+    def _prefetch_group(self, group_id: str) -> None:
+        if self._is_fresh(group_id):
+            return
+        group_data = self._get(group_id, 'chapter-group', f'{self.md_model.group_api_url}/{group_id}')
+        self.cache.save_cache(datetime.now(), group_id, data=group_data, kind='group')
+
+    def _run(self, task, *args) -> None:
+        try:
+            task(*args)
+        except MDownloaderError as e:
+            if e: print(e)
+
+    def _resolve(self, link: str) -> tuple:
+        """Get the id and type of each line in the batch file."""
+        if self.md_model.misc.check_uuid(link):
+            return link, self.md_model.download_type
+        return self.md_model.formatter.id_from_url(link)
+
+    def prefetch(self, links: list) -> None:
+        """Fetch and cache the metadata of every link.
+
+        The ids in the file are fetched first, then the manga and groups their chapters belong to.
+        """
+        start_time = time.time()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for link in links:
+                download_id, download_type = self._resolve(link)
+                if not self._claim(f'{download_type}:{download_id}'):
+                    continue
+
+                if download_type == 'chapter':
+                    executor.submit(self._run, self._prefetch_chapter, download_id)
+                elif download_type in ('title', 'manga'):
+                    with self._lock:
+                        self.manga_ids[download_id] = True
+                elif download_type in ('group', 'user', 'list'):
+                    executor.submit(self._run, self._prefetch_bulk, download_id, download_type)
+                else:
+                    print(f'Skipping {link}, {download_type} downloads can not be prefetched.')
+
+        print(f'Prefetching {len(self.manga_ids)} manga and {len(self.group_ids)} group(s).')
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for manga_id, with_feed in self.manga_ids.items():
+                executor.submit(self._run, self._prefetch_manga, manga_id, with_feed)
+            for group_id in self.group_ids:
+                executor.submit(self._run, self._prefetch_group, group_id)
+
+        self.cache.flush()
+        print(f'Prefetched the metadata of {len(links)} link(s) with {self.requests_made} request(s) in {time.time() - start_time:.1f} seconds.')
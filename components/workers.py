@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+import atexit
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Optional
+
+from .constants import ImpVar
+
+
+_pool = None
+_pool_pid = None
+
+
+
+def process_context() -> multiprocessing.context.BaseContext:
+    """Start new processes from a forkserver, or spawn them where there isn't one.
+
+    Forking copies the locks the download and cache threads are holding, which the
+    child then waits on forever.
+    """
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(start_method)
+
+
+def get_pool() -> Optional[ProcessPoolExecutor]:
+    """The process pool CPU heavy work is sent to, None if CPU_WORKERS is off.
+
+    Each process gets its own pool, rename processes don't use their parent's.
+    """
+    global _pool, _pool_pid
+
+    if ImpVar.CPU_WORKERS <= 0:
+        return None
+
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ProcessPoolExecutor(max_workers=ImpVar.CPU_WORKERS, mp_context=process_context())
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def run_cpu(func: Callable, *args) -> Future:
+    """Run the function on the process pool, or straight away if there isn't one.
+
+    Args:
+        func (Callable): A module level function, so it can be sent to another process.
+
+    Returns:
+        Future: The function's result.
+    """
+    pool = get_pool()
+    if pool is not None:
+        return pool.submit(func, *args)
+
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def xor_decrypt(data: bytes, key: bytes) -> bytes:
+    """Xor the data with the repeating key."""
+    if not data or not key:
+        return bytes(data)
+
+    key_stream = (key * (len(data) // len(key) + 1))[:len(data)]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(key_stream, 'big')).to_bytes(len(data), 'big')
+
+
+@atexit.register
+def _shutdown_pool() -> None:
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.shutdown(wait=True)
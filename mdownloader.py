@@ -3,6 +3,7 @@ import argparse
 import os
 import re
 import shutil
+import sys
 from pathlib import Path
 
 import requests
@@ -148,8 +149,22 @@ if __name__ == "__main__":
     parser.add_argument('--login', default=False, const=True, nargs='?', help='Login to MangaDex.')
     parser.add_argument('--update', default=False, const=True, nargs='?', help='Skip looking for an application update.')
     parser.add_argument('--rename', default=True, const=False, nargs='?', help='Skip renaming downloaded files if the title is wrong.')
-    parser.add_argument('id', help='ID to download. Can be chapter, manga, group, user, list, link/id or file.')
+    parser.add_argument('--prefetch', default=False, const=True, nargs='?', help='Only cache the metadata of the ids in the batch file, no images are downloaded.')
+    parser.add_argument('--stream', default=None, help='Stream each chapter archive to stdout (-) or a named pipe instead of saving it.')
+    parser.add_argument('--stream-meta', default=None, help='File or named pipe to write a json line about each streamed chapter to.')
+    parser.add_argument('--cache-gc', default=False, const=True, nargs='?', help='Delete old cache entries, keeping the cache under CACHE_MAX_SIZE, then exit.')
+    parser.add_argument('--cache-stats', default=False, const=True, nargs='?', help='Show the cache size and hit ratio, then exit.')
+    parser.add_argument('--dedup-report', default=False, const=True, nargs='?', help='Show the pages repeated across the downloaded archives, then exit.')
+    parser.add_argument('--dedup-gc', default=False, const=True, nargs='?', help='Delete the stored dedup pages no download uses anymore, then exit.')
+    parser.add_argument('id', nargs='?', default=None, help='ID to download. Can be chapter, manga, group, user, list, link/id or file.')
 
     args = parser.parse_args()
 
+    if args.stream == '-':
+        # The archives are written to the real stdout, keep every message out of them from here on
+        sys.stdout = sys.stderr
+
+    if args.id is None and not (args.cache_gc or args.cache_stats or args.dedup_report or args.dedup_gc):
+        parser.error('the following arguments are required: id')
+
     check_for_update(args)
@@ -0,0 +1,13 @@
+import pytest
+
+from components import model
+
+
+@pytest.fixture(autouse=True)
+def run_exit_handlers(monkeypatch):
+    """Run the models' exit handlers when the test ends, while still in its temporary folder."""
+    handlers = []
+    monkeypatch.setattr(model.atexit, 'register', lambda func, *args, **kwargs: handlers.append((func, args, kwargs)))
+    yield
+    for func, args, kwargs in reversed(handlers):
+        func(*args, **kwargs)
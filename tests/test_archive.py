@@ -0,0 +1,54 @@
+import io
+import zipfile
+
+import pytest
+
+from components import archive
+from components.archive import deflate, write_compressed
+
+
+class _NonSeekable(io.RawIOBase):
+    """A write-only stream like stdout or a pipe."""
+
+    def __init__(self) -> None:
+        self.buffer = io.BytesIO()
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def write(self, data: bytes) -> int:
+        return self.buffer.write(data)
+
+    def tell(self) -> int:
+        raise OSError('not seekable')
+
+
+def _write_pages(fp) -> None:
+    with zipfile.ZipFile(fp, mode='w') as zip_file:
+        for name, data in (('001.png', b'first page' * 100), ('002.png', b'second page' * 100)):
+            write_compressed(zip_file, name, *deflate(data))
+
+
+@pytest.mark.parametrize('raw_supported', [True, False])
+@pytest.mark.parametrize('seekable', [True, False])
+def test_write_compressed_round_trip(monkeypatch, seekable, raw_supported):
+    """Pre-deflated members read back the same, with or without the zipfile internals."""
+    if not raw_supported:
+        monkeypatch.setattr(archive, 'RAW_ARCHIVE_ATTRIBUTES', archive.RAW_ARCHIVE_ATTRIBUTES + ('_missing',))
+
+    if seekable:
+        fp = io.BytesIO()
+        _write_pages(fp)
+        data = fp.getvalue()
+    else:
+        fp = _NonSeekable()
+        _write_pages(fp)
+        data = fp.buffer.getvalue()
+
+    with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+        assert zip_file.testzip() is None
+        assert zip_file.read('001.png') == b'first page' * 100
+        assert zip_file.read('002.png') == b'second page' * 100
@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from components.model import MDownloader
+
+
+@pytest.fixture(params=['gzip', 'sqlite'])
+def md_model(request, tmp_path, monkeypatch):
+    from components.constants import ImpVar
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ImpVar, 'CACHE_BACKEND', request.param)
+    return MDownloader()
+
+
+def test_unchanged_refetch_renews_cache_date(md_model):
+    """Refetching the same data moves the entry's cache date, so it stops being expired."""
+    cache = md_model.cache
+    data = {"id": "manga-id", "attributes": {"title": {"en": "Title"}}}
+    cache.save_cache(datetime.now() - timedelta(days=30), 'manga-id', data=data, kind='manga')
+    cache.flush()
+    assert cache.check_cache_time(cache.load_cache('manga-id'))
+
+    cache.save_cache(datetime.now(), 'manga-id', data=data, kind='manga')
+    assert not cache.check_cache_time(cache.load_cache('manga-id'))
+
+    cache.flush()
+    reloaded = MDownloader().cache
+    assert not reloaded.check_cache_time(reloaded.load_cache('manga-id'))
+
+
+def test_revalidation_renews_stale_entry(md_model, monkeypatch):
+    """One background refresh with unchanged data makes the stale entry fresh again."""
+    cache = md_model.cache
+    monkeypatch.setattr(cache, 'stale_while_revalidate', True)
+    monkeypatch.setattr(cache, 'max_staleness', 24 * 365)
+    monkeypatch.setattr(md_model, 'wait', lambda *args, **kwargs: None)
+
+    data = {"id": "manga-id", "attributes": {"title": {"en": "Title"}}}
+    cache.save_cache(datetime.now() - timedelta(days=30), 'manga-id', data=data, kind='manga')
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        return data
+
+    assert not cache.check_cache_time(cache.load_cache('manga-id'), 'manga-id', fetch)
+    cache.wait_for_revalidation()
+    assert len(fetches) == 1
+
+    for _ in range(3):
+        assert not cache.check_cache_time(cache.load_cache('manga-id'), 'manga-id', fetch)
+    cache.wait_for_revalidation()
+    assert len(fetches) == 1
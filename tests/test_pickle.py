@@ -0,0 +1,39 @@
+import os
+import pickle
+
+import pytest
+
+from components.model import MDownloader
+
+
+@pytest.mark.parametrize('cache_backend', ['gzip', 'sqlite'])
+def test_model_pickle_round_trip(tmp_path, monkeypatch, cache_backend):
+    """The rename pool and forked processes need the model's parts to survive pickling."""
+    from components.constants import ImpVar
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(ImpVar, 'CACHE_BACKEND', cache_backend)
+    monkeypatch.setattr(ImpVar, 'DURABILITY', 'chapter')
+    md_model = MDownloader()
+
+    formatter = pickle.loads(pickle.dumps(md_model.formatter))
+    assert formatter.model.cache.load_cache('missing-id') == {}
+    formatter.model.durability.written(os.path.join(tmp_path, 'page.jpg'))
+
+    archive_rename = pickle.loads(pickle.dumps(md_model.formatter._archive_rename))
+    assert archive_rename is type(md_model.formatter)._archive_rename
+
+
+def test_library_pickle_round_trip(tmp_path):
+    """The library index opens its own connection after being sent to a rename process."""
+    from components.library import LibraryIndex
+
+    library = LibraryIndex(tmp_path.joinpath('.library.db'))
+    archive_path = tmp_path.joinpath('chapter.cbz')
+    archive_path.write_bytes(b'')
+    library.record('chapter-id', 'hash', archive_path, 'archive', 1, 0)
+
+    copied = pickle.loads(pickle.dumps(library))
+    assert copied.has('chapter-id', 'archive', 'hash')
+    copied.close()
+    library.close()